@@ -1,42 +1,241 @@
 \
 import os
+import re
 import json
+import time
+import logging
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from psycopg2.extras import RealDictCursor
-
-def get_conn():
+from psycopg2 import pool as _pg_pool
+from psycopg2.extras import RealDictCursor, execute_values
+
+# --- Pool de conexiones (compartido por todas las sesiones de Streamlit del proceso) ---
+# Streamlit re-ejecuta los scripts, pero los módulos importados (este incluido) viven
+# una sola vez por proceso, así que el pool se crea una vez por dyno.
+_POOL = None
+_POOL_SLOTS = None
+_POOL_LOCK = threading.Lock()
+_LAST_USED = {}
+
+def _connect_kwargs() -> dict:
     """
     Usa DATABASE_URL si existe (Heroku). Si no, usa variables locales.
     """
     db_url = os.getenv("DATABASE_URL")
     if db_url:
-        return psycopg2.connect(db_url, sslmode=os.getenv("DB_SSLMODE", "require"))
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST", "localhost"),
-        port=int(os.getenv("DB_PORT", "5432")),
-        dbname=os.getenv("DB_NAME", "encuesta_pic"),
-        user=os.getenv("DB_USER", "postgres"),
-        password=os.getenv("DB_PASSWORD", ""),
-        sslmode=os.getenv("DB_SSLMODE", "prefer"),
-    )
+        return {"dsn": db_url, "sslmode": os.getenv("DB_SSLMODE", "require")}
+    return {
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": int(os.getenv("DB_PORT", "5432")),
+        "dbname": os.getenv("DB_NAME", "encuesta_pic"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD", ""),
+        "sslmode": os.getenv("DB_SSLMODE", "prefer"),
+    }
+
+def _get_pool():
+    """Crea (una sola vez por proceso) el pool de conexiones.
+
+    Tamaño configurable con DB_POOL_MIN / DB_POOL_MAX. Si todas las conexiones están
+    ocupadas, quien pide una espera (hasta DB_POOL_TIMEOUT segundos) en vez de fallar.
+    """
+    global _POOL, _POOL_SLOTS
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                minconn = max(0, int(os.getenv("DB_POOL_MIN", "1")))
+                maxconn = max(1, int(os.getenv("DB_POOL_MAX", "10")), minconn)
+                _POOL_SLOTS = threading.BoundedSemaphore(maxconn)
+                _POOL = _pg_pool.ThreadedConnectionPool(minconn, maxconn, **_connect_kwargs())
+    return _POOL
+
+def _is_healthy(conn) -> bool:
+    """Health check al sacar una conexión del pool.
+
+    Solo hace ping (SELECT 1) si la conexión lleva más de DB_POOL_PING_IDLE segundos
+    sin usarse: así el caso normal no paga un round-trip extra, pero las conexiones
+    que Heroku/PgBouncer cerró por inactividad no llegan a las consultas.
+    """
+    if conn.closed:
+        return False
+    idle_limit = float(os.getenv("DB_POOL_PING_IDLE", "30"))
+    if time.monotonic() - _LAST_USED.get(id(conn), 0.0) < idle_limit:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+def _checkout():
+    p = _get_pool()
+    if not _POOL_SLOTS.acquire(timeout=float(os.getenv("DB_POOL_TIMEOUT", "30"))):
+        raise _pg_pool.PoolError("Tiempo de espera agotado esperando una conexión del pool.")
+    try:
+        # Reintenta si la conexión está rota (máximo una vez por slot del pool)
+        for _ in range(p.maxconn + 1):
+            conn = p.getconn()
+            if _is_healthy(conn):
+                return conn
+            _LAST_USED.pop(id(conn), None)
+            p.putconn(conn, close=True)
+        raise _pg_pool.PoolError("No se pudo obtener una conexión sana del pool.")
+    except Exception:
+        _POOL_SLOTS.release()
+        raise
+
+def _checkin(conn, broken: bool = False):
+    p = _get_pool()
+    try:
+        if broken or conn.closed:
+            _LAST_USED.pop(id(conn), None)
+            p.putconn(conn, close=True)
+        else:
+            _LAST_USED[id(conn)] = time.monotonic()
+            p.putconn(conn)
+    finally:
+        _POOL_SLOTS.release()
+
+@contextmanager
+def get_conn():
+    """Presta una conexión del pool: `with get_conn() as conn:`.
+
+    Al salir hace commit (o rollback si hubo excepción) y la devuelve al pool.
+    """
+    conn = _checkout()
+    broken = False
+    try:
+        yield conn
+        if not conn.closed:
+            conn.commit()
+    except BaseException as e:
+        # BaseException: también GeneratorExit (generadores que leen con cursores de servidor)
+        broken = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        raise
+    finally:
+        _checkin(conn, broken=broken)
+
+def close_pool():
+    """Cierra todas las conexiones del pool (p. ej. en tests o al apagar el proceso)."""
+    global _POOL, _POOL_SLOTS
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.closeall()
+        _POOL = None
+        _POOL_SLOTS = None
+        _LAST_USED.clear()
+
+# --- Instrumentación: tiempos de consultas (ring buffer + log de consultas lentas) ---
+# No podemos adjuntar un profiler en los dynos de Heroku; esto deja ver dónde se va el
+# tiempo desde el panel admin (routes/perf.py) y desde `heroku logs`.
+log = logging.getLogger("encuesta.db")
+_QUERY_LOG = deque(maxlen=int(os.getenv("DB_QUERY_LOG_SIZE", "5000")))
+_QUERY_LOG_LOCK = threading.Lock()
+
+def slow_query_ms() -> float:
+    return float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+
+def _fingerprint(query: str) -> str:
+    """Normaliza el SQL para agrupar: sin comentarios, literales ni espacios repetidos."""
+    q = re.sub(r"--[^\n]*", " ", query)
+    q = re.sub(r"'(?:[^']|'')*'", "?", q)
+    q = re.sub(r"\b\d+(?:\.\d+)?\b", "?", q)
+    q = re.sub(r"\s+", " ", q).strip().rstrip(";").strip()
+    return q
+
+def _record_timing(kind: str, name: str, elapsed_s: float, rows):
+    ms = elapsed_s * 1000.0
+    with _QUERY_LOG_LOCK:
+        _QUERY_LOG.append({"ts": time.time(), "kind": kind, "name": name, "ms": ms, "rows": rows})
+    if ms >= slow_query_ms():
+        log.warning("Consulta lenta (%s, %.1f ms, filas=%s): %s", kind, ms, rows, name[:500])
+
+def timed(fn):
+    """Decorador: registra el tiempo total de una función de db (p. ej. get_form)."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+            return result
+        finally:
+            try:
+                rows = len(result) if result is not None else None
+            except TypeError:
+                rows = None
+            _record_timing("func", f"{fn.__name__}()", time.perf_counter() - t0, rows)
+    return wrapper
+
+def query_stats(limit: int = 50) -> list[dict]:
+    """Top de consultas/funciones por tiempo total, según el ring buffer."""
+    with _QUERY_LOG_LOCK:
+        entries = list(_QUERY_LOG)
+    agg = {}
+    for e in entries:
+        a = agg.setdefault((e["kind"], e["name"]), {
+            "kind": e["kind"], "name": e["name"], "calls": 0,
+            "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+        })
+        a["calls"] += 1
+        a["total_ms"] += e["ms"]
+        a["max_ms"] = max(a["max_ms"], e["ms"])
+        a["rows"] += e["rows"] or 0
+    out = sorted(agg.values(), key=lambda a: a["total_ms"], reverse=True)[:limit]
+    for a in out:
+        a["mean_ms"] = a["total_ms"] / a["calls"]
+    return out
+
+def reset_query_stats():
+    with _QUERY_LOG_LOCK:
+        _QUERY_LOG.clear()
 
 def fetchall(query, params=None):
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query, params or ())
-            return cur.fetchall()
+    t0 = time.perf_counter()
+    rows = None
+    try:
+        with get_conn() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, params or ())
+                rows = cur.fetchall()
+                return rows
+    finally:
+        _record_timing("sql", _fingerprint(query), time.perf_counter() - t0, len(rows) if rows is not None else None)
 
 def fetchone(query, params=None):
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query, params or ())
-            return cur.fetchone()
+    t0 = time.perf_counter()
+    row = None
+    try:
+        with get_conn() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, params or ())
+                row = cur.fetchone()
+                return row
+    finally:
+        _record_timing("sql", _fingerprint(query), time.perf_counter() - t0, 1 if row is not None else 0)
 
 def execute(query, params=None):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(query, params or ())
-            conn.commit()
+    t0 = time.perf_counter()
+    rowcount = None
+    try:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params or ())
+                rowcount = cur.rowcount
+                conn.commit()
+    finally:
+        _record_timing("sql", _fingerprint(query), time.perf_counter() - t0, rowcount)
 
 def init_database():
     with get_conn() as conn:
@@ -138,6 +337,231 @@ def init_database():
             cur.execute("CREATE INDEX IF NOT EXISTS idx_answers_question ON survey_answers(question_id);")
             conn.commit()
 
+# --- Almacenamiento de respuestas: filas (EAV) o un JSONB por encuesta ---
+# ANSWERS_STORAGE=rows  -> una fila en survey_answers por pregunta (modo original)
+# ANSWERS_STORAGE=jsonb -> survey_responses.answers = {"<question_id>": valor tipado}
+# Los lectores (export/repair) usan la vista survey_answers_all, que une ambos formatos,
+# así que las dos formas pueden convivir durante la migración.
+
+def answers_storage() -> str:
+    mode = (os.getenv("ANSWERS_STORAGE") or "rows").strip().lower()
+    return "jsonb" if mode == "jsonb" else "rows"
+
+def add_answers_jsonb():
+    """Migración: columna survey_responses.answers + vista survey_answers_all."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE survey_responses ADD COLUMN IF NOT EXISTS answers JSONB NULL;")
+            cur.execute("""
+            CREATE OR REPLACE VIEW survey_answers_all AS
+            SELECT a.response_id, a.question_id,
+                   a.value_text, a.value_bool, a.value_number, a.value_json
+            FROM survey_answers a
+            UNION ALL
+            SELECT r.id AS response_id, kv.key::int AS question_id,
+                   CASE WHEN jsonb_typeof(kv.value) = 'string' THEN kv.value #>> '{}' END AS value_text,
+                   CASE WHEN jsonb_typeof(kv.value) = 'boolean' THEN (kv.value #>> '{}')::boolean END AS value_bool,
+                   CASE WHEN jsonb_typeof(kv.value) = 'number' THEN (kv.value #>> '{}')::double precision END AS value_number,
+                   CASE WHEN jsonb_typeof(kv.value) IN ('array', 'object') THEN kv.value END AS value_json
+            FROM survey_responses r
+            CROSS JOIN LATERAL jsonb_each(r.answers) kv
+            WHERE r.answers IS NOT NULL;
+            """)
+        conn.commit()
+
+def migrate_answers_to_jsonb(version_id: int, batch_size: int = 1000, delete_rows: bool = True) -> int:
+    """Copia las filas de survey_answers al JSONB `answers` de cada encuesta (por lotes).
+
+    Con delete_rows=True borra las filas ya copiadas en la misma transacción del lote.
+    Seguro de ejecutar varias veces. Retorna cuántas encuestas se migraron.
+    """
+    migrated = 0
+    last_id = 0
+    while True:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT id FROM survey_responses
+                    WHERE version_id=%s AND id > %s
+                    ORDER BY id
+                    LIMIT %s;
+                    """,
+                    (version_id, last_id, batch_size),
+                )
+                ids = [int(r[0]) for r in cur.fetchall()]
+                if not ids:
+                    break
+                last_id = ids[-1]
+                cur.execute(
+                    """
+                    UPDATE survey_responses r
+                    SET answers = COALESCE(r.answers, '{}'::jsonb) || sub.doc
+                    FROM (
+                        SELECT a.response_id,
+                               jsonb_object_agg(
+                                   a.question_id::text,
+                                   CASE
+                                       WHEN q.qtype = 'yes_no' AND a.value_bool IS NOT NULL THEN to_jsonb(a.value_bool)
+                                       WHEN a.value_text IS NOT NULL THEN to_jsonb(a.value_text)
+                                       WHEN a.value_number IS NOT NULL THEN to_jsonb(a.value_number)
+                                       ELSE a.value_json
+                                   END
+                               ) AS doc
+                        FROM survey_answers a
+                        JOIN questions q ON q.id = a.question_id
+                        WHERE a.response_id = ANY(%s)
+                        GROUP BY a.response_id
+                    ) sub
+                    WHERE r.id = sub.response_id;
+                    """,
+                    (ids,),
+                )
+                migrated += cur.rowcount
+                if delete_rows:
+                    cur.execute("DELETE FROM survey_answers WHERE response_id = ANY(%s);", (ids,))
+            conn.commit()
+    return migrated
+
+# --- Columnas de identidad indexadas en survey_responses ---
+# Provincia/Municipio/documento viven en metadata (JSONB); estas columnas generadas (STORED)
+# los exponen como texto con índices B-tree para filtrar, agrupar y buscar duplicados sin
+# parsear el JSON de cada fila.
+# Solo leen la clave canónica (metadata->>'province', ...), mientras que la exportación también
+# resuelve por respuesta con code, alias y texto. repair_response_metadata_keys copia esa
+# resolución a la clave canónica (migración paso 15, y el botón "Reparar" en Resultados), así
+# que filtros y conteos coinciden con las columnas exportadas.
+IDENTITY_COLUMNS = ["province", "municipality", "doc_type", "doc_number"]
+
+def add_identity_columns():
+    """Migración: columnas generadas + índices para filtros por identidad y fecha."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            for col in IDENTITY_COLUMNS:
+                cur.execute(f"""
+                ALTER TABLE survey_responses
+                ADD COLUMN IF NOT EXISTS {col} TEXT
+                GENERATED ALWAYS AS (NULLIF(btrim(metadata ->> '{col}'), '')) STORED;
+                """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_created ON survey_responses(version_id, created_at);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_province ON survey_responses(version_id, province);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_municipality ON survey_responses(version_id, municipality);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_doc ON survey_responses(version_id, doc_type, doc_number);")
+        conn.commit()
+
+def count_responses_by_municipality(version_id: int):
+    """Conteo de encuestas por provincia/municipio (usa las columnas indexadas)."""
+    return fetchall(
+        """
+        SELECT province, municipality, COUNT(*) AS n
+        FROM survey_responses
+        WHERE version_id=%s
+        GROUP BY province, municipality
+        ORDER BY province NULLS LAST, municipality NULLS LAST;
+        """,
+        (version_id,),
+    )
+
+# Valores distintos de municipio y provincia por "loose index scan" (CTE recursiva sobre los
+# índices (version_id, municipality, id) / (version_id, province, id)): un salto de índice
+# por valor distinto en vez de agrupar toda la versión. Cuesta lo mismo con 1.000 que con
+# 1.000.000 de encuestas.
+_RESPONSE_LOCATIONS_SQL = """
+    WITH RECURSIVE m AS (
+        (SELECT municipality FROM survey_responses
+         WHERE version_id=%(v)s AND municipality IS NOT NULL
+         ORDER BY municipality LIMIT 1)
+        UNION ALL
+        SELECT (SELECT r.municipality FROM survey_responses r
+                WHERE r.version_id=%(v)s AND r.municipality > m.municipality
+                ORDER BY r.municipality LIMIT 1)
+        FROM m WHERE m.municipality IS NOT NULL
+    ), p AS (
+        (SELECT province FROM survey_responses
+         WHERE version_id=%(v)s AND province IS NOT NULL
+         ORDER BY province LIMIT 1)
+        UNION ALL
+        SELECT (SELECT r.province FROM survey_responses r
+                WHERE r.version_id=%(v)s AND r.province > p.province
+                ORDER BY r.province LIMIT 1)
+        FROM p WHERE p.province IS NOT NULL
+    )
+    SELECT province, municipality FROM (
+        SELECT (SELECT r.province FROM survey_responses r
+                WHERE r.version_id=%(v)s AND r.municipality = m.municipality AND r.province IS NOT NULL
+                LIMIT 1) AS province,
+               m.municipality
+        FROM m WHERE m.municipality IS NOT NULL
+        UNION
+        SELECT p.province, NULL FROM p WHERE p.province IS NOT NULL
+    ) x
+    ORDER BY province NULLS LAST, municipality NULLS LAST;
+"""
+
+def response_locations(version_id: int):
+    """Pares (provincia, municipio) distintos de la versión, para llenar los filtros.
+
+    Cada municipio sale una vez, con la provincia de alguna de sus encuestas. Cada provincia
+    sale además con municipio None (también las que no tienen municipio).
+    """
+    return fetchall(_RESPONSE_LOCATIONS_SQL, {"v": version_id})
+
+def find_responses_by_document(version_id: int, doc_type: str | None, doc_number: str):
+    """Encuestas ya registradas con ese documento (para avisar posibles duplicados)."""
+    if doc_type:
+        return fetchall(
+            "SELECT id, created_at FROM survey_responses WHERE version_id=%s AND doc_type=%s AND doc_number=%s ORDER BY id;",
+            (version_id, doc_type, doc_number),
+        )
+    return fetchall(
+        "SELECT id, created_at FROM survey_responses WHERE version_id=%s AND doc_number=%s ORDER BY id;",
+        (version_id, doc_number),
+    )
+
+# --- Migraciones (ver migrations.py) ---
+
+@contextmanager
+def advisory_lock(key: int):
+    """Lock de sesión de Postgres (pg_advisory_lock) en una conexión propia, fuera del pool.
+
+    Sirve para que varios dynos que arrancan a la vez no corran el bootstrap en paralelo.
+    """
+    conn = psycopg2.connect(**_connect_kwargs())
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (key,))
+        try:
+            yield
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (key,))
+    finally:
+        conn.close()
+
+def ensure_migrations_table():
+    execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        step INTEGER NOT NULL,
+        -- 0 = migración global; si no, id de survey_versions al que se aplicó
+        scope_id INTEGER NOT NULL DEFAULT 0,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (step, scope_id)
+    );
+    """)
+
+def applied_migrations() -> set:
+    """Retorna {(step, scope_id)} ya aplicados."""
+    rows = fetchall("SELECT step, scope_id FROM schema_migrations;")
+    return {(int(r["step"]), int(r["scope_id"])) for r in rows}
+
+def record_migration(step: int, scope_id: int, name: str):
+    execute(
+        "INSERT INTO schema_migrations(step, scope_id, name) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING;",
+        (step, scope_id, name),
+    )
+
 def get_active_version():
     v = fetchone("SELECT * FROM survey_versions WHERE is_active = TRUE ORDER BY id DESC LIMIT 1;")
     return v
@@ -753,72 +1177,128 @@ def standardize_pic_group_questions(version_id: int):
 
     return nchanged
 
-def get_form(version_id: int):
-    # sections
-    sections = fetchall(
-        "SELECT * FROM sections WHERE version_id=%s AND is_active=TRUE ORDER BY sort_order, id;",
-        (version_id,)
-    )
-    section_ids = [s["id"] for s in sections]
-    if not section_ids:
-        return []
+# --- Revisión del formulario ---
+# survey_versions.form_revision sube con cada cambio de secciones/grupos/preguntas/opciones
+# (funciones CRUD de abajo y migraciones por versión). forms.py la usa para saber si su copia
+# en memoria del formulario sigue vigente, también entre dynos (cada uno consulta la revisión).
+_KNOWN_FORM_REVISION = {}
 
-    groups = fetchall(
-        "SELECT * FROM question_groups WHERE version_id=%s AND is_active=TRUE ORDER BY section_id, sort_order, id;",
-        (version_id,)
+def add_form_revision():
+    """Migración: columna survey_versions.form_revision."""
+    execute("ALTER TABLE survey_versions ADD COLUMN IF NOT EXISTS form_revision BIGINT NOT NULL DEFAULT 0;")
+
+def form_revision(version_id: int) -> int:
+    row = fetchone("SELECT form_revision FROM survey_versions WHERE id=%s;", (version_id,))
+    rev = int(row["form_revision"]) if row else 0
+    _KNOWN_FORM_REVISION[version_id] = max(rev, _KNOWN_FORM_REVISION.get(version_id, 0))
+    return rev
+
+def known_form_revision(version_id: int) -> int:
+    """Última revisión vista por este proceso (sin consultar la BD); -1 si ninguna."""
+    return _KNOWN_FORM_REVISION.get(version_id, -1)
+
+def _remember_form_revision(version_id: int, rev: int):
+    _KNOWN_FORM_REVISION[version_id] = max(rev, _KNOWN_FORM_REVISION.get(version_id, 0))
+
+def _bump_form_revision_in_tx(cur, version_id: int) -> int:
+    cur.execute(
+        "UPDATE survey_versions SET form_revision = form_revision + 1 WHERE id=%s RETURNING form_revision;",
+        (version_id,),
     )
-    group_ids = [g["id"] for g in groups]
-    questions = []
-    options = []
-    if group_ids:
-        questions = fetchall(
-            "SELECT * FROM questions WHERE version_id=%s AND is_active=TRUE ORDER BY group_id, sort_order, id;",
-            (version_id,)
-        )
-        q_ids = [q["id"] for q in questions]
-        if q_ids:
-            options = fetchall(
-                "SELECT * FROM question_options WHERE question_id = ANY(%s) ORDER BY question_id, sort_order, id;",
-                (q_ids,)
-            )
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
 
-    # build nested structure
-    opts_by_q = {}
-    for o in options:
-        opts_by_q.setdefault(o["question_id"], []).append(o)
+def _mark_results_wide_stale_in_tx(cur, version_id: int):
+    cur.execute(
+        """
+        INSERT INTO results_wide_state(version_id, is_stale) VALUES(%s, TRUE)
+        ON CONFLICT (version_id) DO UPDATE SET is_stale=TRUE;
+        """,
+        (version_id,),
+    )
 
-    qs_by_group = {}
-    for q in questions:
-        q = dict(q)
-        q["options"] = opts_by_q.get(q["id"], [])
-        qs_by_group.setdefault(q["group_id"], []).append(q)
+def bump_form_revision(version_id: int) -> int:
+    """El formulario cambió: sube la revisión (forms.py recarga su copia en memoria).
 
-    groups_by_section = {}
-    for g in groups:
-        g = dict(g)
-        g["questions"] = qs_by_group.get(g["id"], [])
-        groups_by_section.setdefault(g["section_id"], []).append(g)
+    No toca la tabla ancha: si el cambio afecta cómo se resuelven las filas (textos, codes,
+    tipos), llamar también mark_results_wide_stale. Las funciones CRUD de abajo lo hacen
+    solas, en la misma transacción del cambio y con una sola subida por guardado.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            rev = _bump_form_revision_in_tx(cur, version_id)
+    _remember_form_revision(version_id, rev)
+    return rev
+
+def _question_version(question_id: int):
+    row = fetchone("SELECT version_id FROM questions WHERE id=%s;", (question_id,))
+    return int(row["version_id"]) if row else None
+
+def add_form_tree_indexes():
+    """Migración: índices hijo->padre que usa get_form para armar el árbol en una consulta."""
+    execute("CREATE INDEX IF NOT EXISTS idx_groups_section ON question_groups(section_id, sort_order, id);")
+    execute("CREATE INDEX IF NOT EXISTS idx_questions_group ON questions(group_id, sort_order, id);")
+    execute("CREATE INDEX IF NOT EXISTS idx_options_question ON question_options(question_id, sort_order, id);")
+
+# Todo el formulario activo en una sola consulta: secciones -> grupos -> preguntas ->
+# opciones, ya anidado y ordenado por Postgres. Cada nodo trae todas sus columnas.
+_FORM_TREE_SQL = """
+    SELECT COALESCE(jsonb_agg(
+        to_jsonb(s) || jsonb_build_object('groups', COALESCE((
+            SELECT jsonb_agg(
+                to_jsonb(g) || jsonb_build_object('questions', COALESCE((
+                    SELECT jsonb_agg(
+                        to_jsonb(q) || jsonb_build_object('options', COALESCE((
+                            SELECT jsonb_agg(to_jsonb(o) ORDER BY o.sort_order, o.id)
+                            FROM question_options o
+                            WHERE o.question_id = q.id
+                        ), '[]'::jsonb))
+                        ORDER BY q.sort_order, q.id
+                    )
+                    FROM questions q
+                    WHERE q.group_id = g.id AND q.version_id = s.version_id AND q.is_active
+                ), '[]'::jsonb))
+                ORDER BY g.sort_order, g.id
+            )
+            FROM question_groups g
+            WHERE g.section_id = s.id AND g.version_id = s.version_id AND g.is_active
+        ), '[]'::jsonb))
+        ORDER BY s.sort_order, s.id
+    ), '[]'::jsonb) AS form
+    FROM sections s
+    WHERE s.version_id = %s AND s.is_active;
+"""
+
+@timed
+def get_form(version_id: int):
+    """Formulario activo de la versión: [sección{groups: [grupo{questions: [pregunta{options}]}]}].
 
-    form = []
-    for s in sections:
-        s = dict(s)
-        s["groups"] = groups_by_section.get(s["id"], [])
-        form.append(s)
-    return form
+    Una sola consulta (una conexión del pool) en vez de una por nivel.
+    """
+    row = fetchone(_FORM_TREE_SQL, (version_id,))
+    return row["form"] if row else []
 
 def create_response(version_id: int, metadata: dict) -> int:
+    """Encuesta vacía (para guardar respuesta por respuesta con save_answer).
+
+    Al terminar, llamar refresh_results_wide_rows([id]) una vez para su fila ancha.
+    submit_response hace todo en una transacción y es lo que usa la página de la encuesta.
+    """
     row = fetchone(
         "INSERT INTO survey_responses(version_id, metadata) VALUES(%s,%s) RETURNING id;",
         (version_id, json.dumps(metadata or {}))
     )
     return int(row["id"])
 
-def save_answer(response_id: int, question: dict, value):
-    qtype = question["qtype"]
+def _encode_answer(qtype: str, value):
+    """Convierte el valor del widget a (value_text, value_bool, value_number, value_json).
+
+    Retorna None si no hay nada que guardar.
+    """
     text_val = bool_val = num_val = json_val = None
 
     if value is None:
-        return
+        return None
     elif qtype == "yes_no":
         bool_val = True if value == "Sí" else False if value == "No" else None
         text_val = value
@@ -836,11 +1316,88 @@ def save_answer(response_id: int, question: dict, value):
     else:
         # fallback
         json_val = json.dumps(value)
+    return (text_val, bool_val, num_val, json_val)
+
+def _answer_json_value(qtype: str, encoded):
+    """Valor tipado para el JSONB `answers` (bool / texto / número / lista)."""
+    text_val, bool_val, num_val, json_val = encoded
+    if qtype == "yes_no" and bool_val is not None:
+        return bool_val
+    if text_val is not None:
+        return text_val
+    if num_val is not None:
+        return num_val
+    if json_val is not None:
+        return json.loads(json_val)
+    if bool_val is not None:
+        # Solo pasa al leer filas viejas de una pregunta que dejó de ser yes_no
+        return bool_val
+    return None
 
-    execute(
-        "INSERT INTO survey_answers(response_id, question_id, value_text, value_bool, value_number, value_json) VALUES(%s,%s,%s,%s,%s,%s);",
-        (response_id, question["id"], text_val, bool_val, num_val, json_val)
-    )
+def save_answer(response_id: int, question: dict, value):
+    encoded = _encode_answer(question["qtype"], value)
+    if encoded is None:
+        return
+
+    if answers_storage() == "jsonb":
+        execute(
+            "UPDATE survey_responses SET answers = COALESCE(answers, '{}'::jsonb) || jsonb_build_object(%s::text, %s::jsonb) WHERE id=%s;",
+            (str(question["id"]), json.dumps(_answer_json_value(question["qtype"], encoded)), response_id)
+        )
+    else:
+        execute(
+            "INSERT INTO survey_answers(response_id, question_id, value_text, value_bool, value_number, value_json) VALUES(%s,%s,%s,%s,%s,%s);",
+            (response_id, question["id"]) + encoded
+        )
+
+@timed
+def submit_response(version_id: int, metadata: dict, answers) -> int:
+    """Guarda una encuesta completa en UNA transacción y retorna su id.
+
+    `answers` es un iterable de (question_id, qtype, value).
+    Inserta la fila de survey_responses y todas las de survey_answers con un único
+    INSERT multi-fila (o, con ANSWERS_STORAGE=jsonb, un solo INSERT con el JSONB
+    `answers`); si algo falla no queda una respuesta a medias.
+    """
+    encoded_answers = []
+    for qid, qtype, value in answers:
+        encoded = _encode_answer(qtype, value)
+        if encoded is not None:
+            encoded_answers.append((int(qid), qtype, encoded))
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if answers_storage() == "jsonb":
+                doc = {str(qid): _answer_json_value(qtype, encoded) for qid, qtype, encoded in encoded_answers}
+                cur.execute(
+                    "INSERT INTO survey_responses(version_id, metadata, answers) VALUES(%s,%s,%s) RETURNING id;",
+                    (version_id, json.dumps(metadata or {}), json.dumps(doc, separators=(",", ":")))
+                )
+                response_id = int(cur.fetchone()[0])
+            else:
+                cur.execute(
+                    "INSERT INTO survey_responses(version_id, metadata) VALUES(%s,%s) RETURNING id;",
+                    (version_id, json.dumps(metadata or {}))
+                )
+                response_id = int(cur.fetchone()[0])
+                rows = [(response_id, qid) + encoded for qid, _, encoded in encoded_answers]
+                if rows:
+                    execute_values(
+                        cur,
+                        "INSERT INTO survey_answers(response_id, question_id, value_text, value_bool, value_number, value_json) VALUES %s;",
+                        rows,
+                        page_size=1000,
+                    )
+        # Fila de la tabla ancha de resultados (misma transacción)
+        _upsert_results_wide_in_tx(
+            conn,
+            version_id,
+            response_id,
+            metadata,
+            [(qid, _decode_answer(qtype, *encoded)) for qid, qtype, encoded in encoded_answers],
+        )
+        conn.commit()
+    return response_id
 
 def list_users():
     return fetchall("SELECT id, username, role, is_active, created_at FROM users ORDER BY id;")
@@ -861,18 +1418,88 @@ def count_responses(version_id: int) -> int:
     row = fetchone("SELECT COUNT(*) AS n FROM survey_responses WHERE version_id=%s;", (version_id,))
     return int(row["n"])
 
-def list_response_summaries(version_id: int, limit: int = 200):
-    """Lista respuestas para administración (borrado/validación)."""
-    return fetchall(
-        """
-        SELECT id, created_at, metadata
+# Navegador de encuestas: paginación por llave (keyset) sobre (version_id, id), de la más
+# reciente a la más antigua. Cada página es un recorrido de índice de `limit` filas, sin
+# OFFSET, así que cuesta lo mismo en la página 1 que en la 500.
+BROWSE_FILTER_KEYS = ("province", "municipality", "doc_type", "doc_number")
+
+def add_response_browse_indexes():
+    """Migración: índices (version_id, [filtro,] id) para el navegador de encuestas.
+
+    Reemplazan los de add_identity_columns: (version_id, municipio/provincia, id) cubre
+    también los filtros de conteo y exportación, y (version_id, doc_number, doc_type) sirve
+    la búsqueda por documento con o sin tipo.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_id ON survey_responses(version_id, id);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_municipality_id ON survey_responses(version_id, municipality, id);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_province_id ON survey_responses(version_id, province, id);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_responses_version_doc ON survey_responses(version_id, doc_number, doc_type);")
+            cur.execute("DROP INDEX IF EXISTS idx_responses_version_municipality, idx_responses_version_province, idx_responses_doc;")
+
+def browse_responses(version_id: int, filters: dict | None = None, after_id: int | None = None, limit: int = 50):
+    """Una página de encuestas (más recientes primero).
+
+    - after_id: id de la última fila de la página anterior (None = primera página).
+    - filters: igualdad sobre las columnas indexadas (ver BROWSE_FILTER_KEYS).
+    Retorna (filas, hay_mas) donde hay_mas indica si existe una página siguiente.
+    """
+    filters = {k: v for k, v in (filters or {}).items() if v not in (None, "")}
+    unknown = set(filters) - set(BROWSE_FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Filtros no soportados: {', '.join(sorted(unknown))}")
+    where = ["version_id=%s"] + [f"{k}=%s" for k in filters]
+    params = [version_id] + [str(v).strip() for v in filters.values()]
+    if after_id is not None:
+        where.append("id < %s")
+        params.append(after_id)
+    rows = fetchall(
+        f"""
+        SELECT id, created_at, province, municipality, doc_type, doc_number,
+               metadata ->> 'full_name' AS full_name, metadata ->> 'encuestador' AS encuestador
         FROM survey_responses
-        WHERE version_id=%s
+        WHERE {" AND ".join(where)}
         ORDER BY id DESC
         LIMIT %s;
         """,
-        (version_id, limit),
+        params + [limit + 1],
     )
+    return rows[:limit], len(rows) > limit
+
+def get_response_detail(version_id: int, response_id: int):
+    """Una encuesta con sus respuestas decodificadas, en el orden del formulario (o None)."""
+    head = fetchone(
+        "SELECT id, created_at, metadata FROM survey_responses WHERE id=%s AND version_id=%s;",
+        (response_id, version_id),
+    )
+    if not head:
+        return None
+    qrows = export_questions(version_id)
+    qtypes = {q["id"]: q["qtype"] for q in qrows}
+    values = {
+        int(a["question_id"]): _decode_answer(
+            qtypes.get(a["question_id"]), a["value_text"], a["value_bool"], a["value_number"], a["value_json"]
+        )
+        for a in fetchall(
+            """
+            SELECT question_id, value_text, value_bool, value_number, value_json
+            FROM survey_answers_all WHERE response_id=%s;
+            """,
+            (response_id,),
+        )
+    }
+    head["answers"] = [
+        {
+            "section": q["section_name"],
+            "group": q["group_title"],
+            "question": q["question_text"],
+            "value": values[q["id"]],
+        }
+        for q in qrows
+        if q["id"] in values
+    ]
+    return head
 
 def delete_responses(response_ids: list[int]):
     """Borra respuestas (cascada borra answers)."""
@@ -884,124 +1511,249 @@ def delete_responses(response_ids: list[int]):
     )
 
 def delete_all_responses(version_id: int):
-    execute("DELETE FROM survey_responses WHERE version_id=%s;", (version_id,))
+    return delete_responses_by_filter(version_id, {})
+
+def count_responses_by_filter(version_id: int, filters: dict | None = None) -> int:
+    """Cuántas encuestas cumplen los filtros (mismas claves que EXPORT_FILTER_KEYS)."""
+    where, params = _export_filter_sql(version_id, filters)
+    row = fetchone(f"SELECT COUNT(*) AS n FROM survey_responses WHERE {where};", params)
+    return int(row["n"])
+
+def delete_responses_by_filter(version_id: int, filters: dict | None = None, batch_size: int = 200,
+                               progress=None, vacuum: bool = True, retries: int = 3) -> tuple[int, int]:
+    """Borra las encuestas que cumplen los filtros, en lotes de `batch_size`.
+
+    Cada lote es una transacción corta (con sus ~300 respuestas por encuesta en cascada),
+    así las encuestas que se están guardando en campo no quedan esperando un lock largo.
+    SKIP LOCKED salta filas que otra transacción tenga tomadas: si un lote sale vacío pero
+    aún hay coincidencias, se reintenta hasta `retries` veces tras una pausa corta. Al final
+    corre ANALYZE y encola VACUUM en segundo plano (ver maintenance_after_delete).
+    `progress(borradas, total)` se llama después de cada lote.
+    Retorna (borradas, pendientes): pendientes son las que siguen cumpliendo los filtros
+    (bloqueadas por otra transacción hasta el final); 0 si se borró todo.
+    """
+    where, params = _export_filter_sql(version_id, filters)
+    total = count_responses_by_filter(version_id, filters)
+    done = 0
+    remaining = 0
+    attempts = 0
+    while True:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    DELETE FROM survey_responses
+                    WHERE id IN (
+                        SELECT id FROM survey_responses
+                        WHERE {where}
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    );
+                """, params + [batch_size])
+                n = cur.rowcount
+        if n:
+            done += n
+            attempts = 0
+            if progress:
+                progress(done, max(total, done))
+            continue
+        remaining = count_responses_by_filter(version_id, filters)
+        if not remaining or attempts >= retries:
+            break
+        attempts += 1
+        time.sleep(0.5 * attempts)
+    if done:
+        log.info("deleted %s responses of version %s (filters=%s)", done, version_id, filters)
+        maintenance_after_delete(vacuum=vacuum)
+    if remaining:
+        log.warning("%s responses of version %s left undeleted (locked) (filters=%s)", remaining, version_id, filters)
+    return done, remaining
+
+_MAINTENANCE_TABLES = ("survey_responses", "survey_answers", "survey_results_wide")
+# VACUUM de tablas grandes tarda minutos: corre en un hilo de fondo (uno por proceso, como
+# las exportaciones) para no bloquear el script de Streamlit que hizo el borrado.
+_maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+_vacuum_pending = threading.Event()
+
+def _maintenance(statement: str):
+    # VACUUM no puede correr dentro de una transacción: conexión propia en autocommit
+    conn = psycopg2.connect(**_connect_kwargs())
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for table in _MAINTENANCE_TABLES:
+                cur.execute(f"{statement} {table};")
+    finally:
+        conn.close()
+
+def _vacuum_in_background():
+    _vacuum_pending.clear()
+    try:
+        _maintenance("VACUUM")
+    except Exception:
+        log.exception("background VACUUM failed")
+
+def maintenance_after_delete(vacuum: bool = True):
+    """ANALYZE de las tablas de respuestas tras un borrado grande (+ VACUUM en segundo plano).
+
+    ANALYZE es rápido y corre aquí, así las consultas siguientes ya usan estadísticas al día.
+    VACUUM (devolver el espacio) se encola en un hilo de fondo; si ya hay uno pendiente, no
+    se encola otro. Ninguno bloquea inserciones ni lecturas.
+    """
+    _maintenance("ANALYZE")
+    if vacuum and not _vacuum_pending.is_set():
+        _vacuum_pending.set()
+        _maintenance_executor.submit(_vacuum_in_background)
 
 
+@timed
 def repair_response_metadata_keys(version_id: int):
     """Intenta rellenar metadata(province/municipality/identificación) en respuestas existentes,
-    leyendo de survey_answers por code o por coincidencia de texto. Seguro de ejecutar varias veces.
+    leyendo de las respuestas por code, de alias en metadata o por coincidencia de texto (el mismo
+    orden que usa la exportación). Seguro de ejecutar varias veces; corre como migración (paso 15)
+    para que las columnas generadas de identidad coincidan con Provincia/Municipio exportados.
+
+    Todo en un solo UPDATE: qué preguntas sirven para cada clave se resuelve en Python (una vez
+    por pregunta) y Postgres calcula y aplica las 8 claves para todas las encuestas a la vez.
     """
-    import json as _json
-    # Traer respuestas
-    responses = fetchall("SELECT id, metadata FROM survey_responses WHERE version_id=%s ORDER BY id;", (version_id,))
-    if not responses:
-        return 0
-    # Traer posibles respuestas por response_id con su code y textos normalizados
-    ans = fetchall("""
-        SELECT r.id AS response_id,
-               q.code,
-               COALESCE(q.label, q.text) AS qtext,
-               s.name AS section_name, g.title AS group_title,
-               a.value_text, a.value_bool, a.value_number, a.value_json, q.qtype
-        FROM survey_responses r
-        JOIN survey_answers a ON a.response_id=r.id
-        JOIN questions q ON q.id=a.question_id
-        JOIN question_groups g ON g.id=q.group_id
-        JOIN sections s ON s.id=g.section_id
-        WHERE r.version_id=%s
-    """, (version_id,))
-    import pandas as _pd, unicodedata as _ud, re as _re
-    def _norm(x):
-        x=(x or "").lower().strip()
-        x=_ud.normalize("NFKD", x).encode("ascii","ignore").decode("ascii")
-        x=_re.sub(r"[^a-z0-9]+","",x)
-        return x
-    df=_pd.DataFrame(ans) if ans else _pd.DataFrame(columns=["response_id","code","qtext","section_name","group_title","value_text","value_bool","value_number","value_json","qtype"])
-    if not df.empty:
-        def _ans_to_str(r):
-            if r["qtype"]=="yes_no":
-                if r["value_bool"] is True: return "Sí"
-                if r["value_bool"] is False: return "No"
-            if r["value_text"] is not None: return r["value_text"]
-            if r["value_number"] is not None: return r["value_number"]
-            if r["value_json"] is not None:
-                try: return _json.loads(r["value_json"])
-                except Exception: return r["value_json"]
-            return None
-        df["answer"]=df.apply(_ans_to_str, axis=1)
-        df["sec_n"]=df["section_name"].map(_norm)
-        df["grp_n"]=df["group_title"].map(_norm)
-        df["q_n"]=df["qtext"].map(_norm)
-
-    key_specs = {
-        "province": ("preguntas iniciales","ubic","provincia"),
-        "municipality": ("preguntas iniciales","ubic","municip"),
-        "full_name": ("preguntas iniciales","ident","nombre"),
-        "doc_type": ("preguntas iniciales","ident","tipodedocument"),
-        "doc_number": ("preguntas iniciales","ident","numerodedocument"),
-        "phone": ("preguntas iniciales","ident","celular"),
-        "email": ("preguntas iniciales","ident","correo"),
-        "role": ("preguntas iniciales","ident","cargo"),
-    }
+    # Candidatas por clave, en el mismo orden que la exportación: prioridad 0 = pregunta con
+    # code exacto, 1 = alias en metadata (EXPORT_META_ALIASES), 2 = coincidencia de texto
+    builder = _WideRowBuilder(export_questions(version_id))
+    keys, qids, prios = [], [], []
+    for qid, info in builder.questions.items():
+        if info["code"] in EXPORT_KEY_MATCH:
+            keys.append(info["code"]); qids.append(qid); prios.append(0)
+        for key in info["fallback"]:
+            keys.append(key); qids.append(qid); prios.append(2)
+    alias_keys, aliases = [], []
+    for key, names in EXPORT_META_ALIASES.items():
+        for name in names:
+            if name != key:
+                alias_keys.append(key); aliases.append(name)
 
-    updated=0
-    for r in responses:
-        rid=int(r["id"])
-        meta = {}
-        try:
-            if isinstance(r["metadata"], str) and r["metadata"]:
-                meta=_json.loads(r["metadata"])
-            elif isinstance(r["metadata"], dict):
-                meta=r["metadata"]
-        except Exception:
-            meta={}
-        changed=False
-        for key,(sec_c,grp_c,q_c) in key_specs.items():
-            if meta.get(key) not in (None,""):
-                continue
-            val=None
-            if not df.empty:
-                # primero por code exacto
-                sub=df[(df["response_id"]==rid) & (df["code"]==key)]
-                if not sub.empty:
-                    val=sub.iloc[0]["answer"]
-                else:
-                    sub=df[(df["response_id"]==rid) &
-                           (df["sec_n"].str.contains(_norm(sec_c))) &
-                           (df["grp_n"].str.contains(_norm(grp_c))) &
-                           (df["q_n"].str.contains(_norm(q_c)))]
-                    if not sub.empty:
-                        val=sub.iloc[0]["answer"]
-            if val not in (None,""):
-                meta[key]=val
-                changed=True
-        if changed:
-            execute("UPDATE survey_responses SET metadata=%s WHERE id=%s;", (_json.dumps(meta), rid))
-            updated+=1
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH keymap AS (
+                    SELECT * FROM unnest(%s::text[], %s::int[], %s::int[]) AS k(key, question_id, prio)
+                ),
+                cand AS (
+                    SELECT a.response_id, k.key, k.prio, a.question_id,
+                           CASE
+                               WHEN q.qtype = 'yes_no' AND a.value_bool IS TRUE THEN to_jsonb('Sí'::text)
+                               WHEN q.qtype = 'yes_no' AND a.value_bool IS FALSE THEN to_jsonb('No'::text)
+                               WHEN a.value_text IS NOT NULL THEN to_jsonb(a.value_text)
+                               WHEN a.value_number IS NOT NULL THEN to_jsonb(a.value_number)
+                               ELSE a.value_json
+                           END AS val
+                    FROM survey_responses r
+                    JOIN survey_answers_all a ON a.response_id = r.id
+                    JOIN keymap k ON k.question_id = a.question_id
+                    JOIN questions q ON q.id = a.question_id
+                    WHERE r.version_id = %s
+                      -- solo claves que faltan (NULL o "") en metadata
+                      AND COALESCE(r.metadata ->> k.key, '') = ''
+                    UNION ALL
+                    SELECT r.id, m.key, 1, 0, r.metadata -> m.alias
+                    FROM survey_responses r
+                    JOIN unnest(%s::text[], %s::text[]) AS m(key, alias) ON r.metadata ? m.alias
+                    WHERE r.version_id = %s
+                      AND COALESCE(r.metadata ->> m.key, '') = ''
+                ),
+                best AS (
+                    SELECT DISTINCT ON (response_id, key) response_id, key, val
+                    FROM cand
+                    WHERE val IS NOT NULL AND val <> 'null'::jsonb AND val <> '""'::jsonb
+                    ORDER BY response_id, key, prio, question_id
+                ),
+                patch AS (
+                    SELECT response_id, jsonb_object_agg(key, val) AS doc
+                    FROM best
+                    GROUP BY response_id
+                )
+                UPDATE survey_responses r
+                SET metadata = r.metadata || patch.doc
+                FROM patch
+                WHERE r.id = patch.response_id;
+            """, (keys, qids, prios, version_id, alias_keys, aliases, version_id))
+            updated = cur.rowcount
+        conn.commit()
+    if updated:
+        mark_results_wide_stale(version_id)
     return updated
 
 
-def export_answers_wide(version_id: int):
+# --- Exportación ---
+
+# Columnas explícitas para ubicación / identificación (más fácil para análisis)
+EXPORT_KEY_COLUMNS = {
+    "province": "Provincia",
+    "municipality": "Municipio",
+    "full_name": "Nombre completo",
+    "doc_type": "Tipo de documento",
+    "doc_number": "Número de documento",
+    "phone": "Número de celular",
+    "email": "Correo electrónico",
+    "role": "Cargo o rol",
+}
+
+# Alias con los que esos campos pueden venir en survey_responses.metadata
+EXPORT_META_ALIASES = {
+    "province": ["province", "Provincia", "provincia"],
+    "municipality": ["municipality", "Municipio", "municipio"],
+    "full_name": ["full_name", "Nombre completo", "nombre_completo", "nombre"],
+    "doc_type": ["doc_type", "Tipo de documento", "tipo_documento"],
+    "doc_number": ["doc_number", "Número de documento", "numero_documento"],
+    "phone": ["phone", "Número de celular", "numero_celular", "celular", "telefono"],
+    "email": ["email", "Correo electrónico", "correo", "correo_electronico"],
+    "role": ["role", "Cargo o rol", "cargo", "rol"],
+}
+
+# Fallback por texto (sección, grupo, pregunta) cuando la pregunta no tiene `code`
+EXPORT_KEY_MATCH = {
+    "province": ("preguntas iniciales", "ubic", "provincia"),
+    "municipality": ("preguntas iniciales", "ubic", "municip"),
+    "full_name": ("preguntas iniciales", "ident", "nombre"),
+    "doc_type": ("preguntas iniciales", "ident", "tipodedocument"),
+    "doc_number": ("preguntas iniciales", "ident", "numerodedocument"),
+    "phone": ("preguntas iniciales", "ident", "celular"),
+    "email": ("preguntas iniciales", "ident", "correo"),
+    "role": ("preguntas iniciales", "ident", "cargo"),
+}
+
+@timed
+def export_answers_wide(version_id: int, live: bool = False, filters: dict | None = None):
     """Retorna DataFrame (1 fila por encuesta, 1 columna por pregunta).
 
     Importante:
     - Siempre incluye las columnas clave (Provincia/Municipio/Identificación) aunque estén vacías.
     - Siempre incluye todas las preguntas activas de la versión (aunque todas estén en blanco),
       para que el Excel tenga estructura estable.
+    - Por defecto lee la tabla materializada survey_results_wide. Con live=True recalcula
+      el pivot directamente desde las respuestas (útil para verificar la tabla).
+    - `filters` (fecha, provincia, municipio, encuestador, rango de ids; ver EXPORT_FILTER_KEYS)
+      se aplica en SQL. Solo con la tabla materializada.
     """
     import pandas as pd
 
-    # 1) Traer todas las respuestas (pueden tener valores NULL)
+    if live and filters:
+        raise ValueError("Los filtros solo se soportan leyendo la tabla materializada (live=False).")
+    if not live:
+        header, rows = export_wide_rows(version_id, filters=filters)
+        rows = list(rows)
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame(rows, columns=header)
+
+    # 1) Traer todas las respuestas (pueden tener valores NULL). Los textos de sección/grupo/
+    #    pregunta se traen una vez por pregunta (export_questions), no en cada fila.
     rows = fetchall("""
         SELECT r.id AS response_id, r.created_at, r.metadata,
-               s.name AS section_name, g.title AS group_title,
-               q.id AS question_id, q.code AS code, COALESCE(q.label, q.text) AS question_text, q.qtype,
+               q.id AS question_id, q.code AS code, q.qtype,
                a.value_text, a.value_bool, a.value_number, a.value_json
         FROM survey_responses r
-        JOIN survey_answers a ON a.response_id = r.id
+        JOIN survey_answers_all a ON a.response_id = r.id
         JOIN questions q ON q.id = a.question_id
-        JOIN question_groups g ON g.id = q.group_id
-        JOIN sections s ON s.id = g.section_id
         WHERE r.version_id=%s
         ORDER BY r.id, q.id;
     """, (version_id,))
@@ -1011,26 +1763,10 @@ def export_answers_wide(version_id: int):
         return pd.DataFrame()
 
     df = pd.DataFrame(rows)
+    qrows = export_questions(version_id)
 
-    def answer_to_str(row):
-        if row["qtype"] == "yes_no":
-            if row["value_bool"] is True:
-                return "Sí"
-            if row["value_bool"] is False:
-                return "No"
-        if row["value_text"] is not None:
-            return row["value_text"]
-        if row["value_number"] is not None:
-            return row["value_number"]
-        if row["value_json"] is not None:
-            try:
-                return json.loads(row["value_json"])
-            except Exception:
-                return row["value_json"]
-        return None
-
-    df["answer"] = df.apply(answer_to_str, axis=1)
-    df["col"] = df.apply(lambda r: f'{r["section_name"]} | {r["group_title"]} | {r["question_text"]}', axis=1)
+    df["answer"] = _decode_answer_frame(df)
+    qinfo = _question_frame(pd.DataFrame(qrows).rename(columns={"id": "question_id"}), "question_text")
 
     # 2) Metadata por encuesta
     meta = df[["response_id", "created_at", "metadata"]].drop_duplicates("response_id").set_index("response_id")
@@ -1043,32 +1779,14 @@ def export_answers_wide(version_id: int):
     meta_cols = pd.json_normalize(meta_parsed).set_index(meta.index)
 
     # 3) Columnas explícitas para ubicación / identificación (más fácil para análisis)
-    key_map = {
-        "province": "Provincia",
-        "municipality": "Municipio",
-        "full_name": "Nombre completo",
-        "doc_type": "Tipo de documento",
-        "doc_number": "Número de documento",
-        "phone": "Número de celular",
-        "email": "Correo electrónico",
-        "role": "Cargo o rol",
-    }
+    key_map = EXPORT_KEY_COLUMNS
 
     # Creamos el pivot por código, pero garantizando columnas aunque estén vacías
     code_cols = list(key_map.keys())
     code_pivot = pd.DataFrame(index=meta.index, columns=code_cols)
 
     # Primero llenar desde metadata (si existe)
-    meta_key_map = {
-        "province": ["province", "Provincia", "provincia"],
-        "municipality": ["municipality", "Municipio", "municipio"],
-        "full_name": ["full_name", "Nombre completo", "nombre_completo", "nombre"],
-        "doc_type": ["doc_type", "Tipo de documento", "tipo_documento"],
-        "doc_number": ["doc_number", "Número de documento", "numero_documento"],
-        "phone": ["phone", "Número de celular", "numero_celular", "celular", "telefono"],
-        "email": ["email", "Correo electrónico", "correo", "correo_electronico"],
-        "role": ["role", "Cargo o rol", "cargo", "rol"],
-    }
+    meta_key_map = EXPORT_META_ALIASES
     for k, aliases in meta_key_map.items():
         if k not in code_pivot.columns:
             continue
@@ -1085,17 +1803,9 @@ def export_answers_wide(version_id: int):
     # Fallback: si por alguna razón los `code` no quedaron asignados en la BD (o el encuestador
     # respondió una pregunta duplicada sin code), intentamos completar estas columnas buscando
     # por texto y por ubicación en la encuesta.
-    def _norm_txt(x: str) -> str:
-        x = (x or "").lower().strip()
-        import re as _re, unicodedata as _ud
-        x = _ud.normalize("NFKD", x).encode("ascii", "ignore").decode("ascii")
-        x = _re.sub(r"[^a-z0-9]+", "", x)
-        return x
-
-    df_fallback = df.copy()
-    df_fallback["sec_n"] = df_fallback["section_name"].map(_norm_txt)
-    df_fallback["grp_n"] = df_fallback["group_title"].map(_norm_txt)
-    df_fallback["q_n"] = df_fallback["question_text"].map(_norm_txt)
+    df_fallback = df[["response_id", "question_id", "answer"]].join(
+        qinfo[["sec_n", "grp_n", "q_n"]], on="question_id"
+    )
 
     def _fill_from_match(out_col: str, sec_contains: str, grp_contains: str, q_contains: str):
         # Solo llena donde está vacío
@@ -1105,9 +1815,9 @@ def export_answers_wide(version_id: int):
         if not mask_empty.any():
             return
         m = (
-            df_fallback["sec_n"].str.contains(_norm_txt(sec_contains))
-            & df_fallback["grp_n"].str.contains(_norm_txt(grp_contains))
-            & df_fallback["q_n"].str.contains(_norm_txt(q_contains))
+            df_fallback["sec_n"].str.contains(_norm_match(sec_contains), regex=False, na=False)
+            & df_fallback["grp_n"].str.contains(_norm_match(grp_contains), regex=False, na=False)
+            & df_fallback["q_n"].str.contains(_norm_match(q_contains), regex=False, na=False)
         )
         sub = df_fallback[m]
         if sub.empty:
@@ -1117,9 +1827,7 @@ def export_answers_wide(version_id: int):
         # para hacerlo robusto.
         ser = sub.groupby("response_id")["answer"].first()
         # Escribimos solo en filas vacías
-        for rid, val in ser.items():
-            if rid in code_pivot.index and pd.isna(code_pivot.at[rid, out_col]):
-                code_pivot.at[rid, out_col] = val
+        code_pivot[out_col] = code_pivot[out_col].where(~mask_empty, ser.reindex(code_pivot.index))
 
     _fill_from_match("Provincia", "preguntas iniciales", "ubic", "provincia")
     _fill_from_match("Municipio", "preguntas iniciales", "ubic", "municip")
@@ -1130,45 +1838,826 @@ def export_answers_wide(version_id: int):
     _fill_from_match("Correo electrónico", "preguntas iniciales", "ident", "correo")
     _fill_from_match("Cargo o rol", "preguntas iniciales", "ident", "cargo")
 
-    # 4) Pivot general por texto de pregunta
-    pivot = df.pivot_table(index="response_id", columns="col", values="answer", aggfunc="first")
+    # 4) Pivot general por question_id (enteros: barato de hashear y estable si se renombran preguntas)
+    pivot = df.groupby(["response_id", "question_id"])["answer"].first().unstack()
 
     # 5) Asegurar que el Excel incluya TODAS las preguntas activas de la versión (aunque estén vacías)
-    qrows = fetchall("""
-        SELECT s.sort_order AS sec_order, g.sort_order AS grp_order, q.sort_order AS q_order,
-               s.name AS section_name, g.title AS group_title, COALESCE(q.label, q.text) AS question_text
-        FROM questions q
-        JOIN question_groups g ON g.id = q.group_id
-        JOIN sections s ON s.id = g.section_id
-        WHERE q.version_id=%s AND q.is_active=TRUE AND g.is_active=TRUE AND s.is_active=TRUE
-        ORDER BY s.sort_order, g.sort_order, q.sort_order, q.id;
-    """, (version_id,))
-
-    all_question_cols = [f'{r["section_name"]} | {r["group_title"]} | {r["question_text"]}' for r in qrows]
-
-    # Reindex: agrega columnas faltantes con NaN y respeta el orden del formulario
-    pivot = pivot.reindex(columns=all_question_cols)
+    #    y respetar el orden del formulario. Las etiquetas se ponen al final.
+    header = export_question_header(qrows)
+    pivot = pivot.reindex(columns=[qid for qid, _ in header])
+    pivot.columns = [label for _, label in header]
 
     out = meta.join(code_pivot, how="left").join(pivot, how="left").reset_index()
     return out
 
+_EXPORT_QUESTIONS_SQL = """
+    SELECT q.id, q.code, q.qtype, COALESCE(q.label, q.text) AS question_text,
+           s.name AS section_name, g.title AS group_title,
+           (q.is_active AND g.is_active AND s.is_active) AS is_visible
+    FROM questions q
+    JOIN question_groups g ON g.id = q.group_id
+    JOIN sections s ON s.id = g.section_id
+    WHERE q.version_id=%s
+    ORDER BY s.sort_order, g.sort_order, q.sort_order, q.id;
+"""
+
+def export_questions(version_id: int):
+    """Todas las preguntas de la versión (activas o no) con lo necesario para exportar."""
+    return fetchall(_EXPORT_QUESTIONS_SQL, (version_id,))
+
+def export_question_header(qrows) -> list[tuple[int, str]]:
+    """[(question_id, etiqueta)] de las preguntas visibles, en el orden del formulario.
+
+    Etiqueta: "sección | grupo | pregunta". Si dos preguntas quedan con la misma etiqueta,
+    se les agrega el id para que sigan siendo columnas distintas.
+    """
+    visible = [q for q in qrows if q["is_visible"]]
+    labels = [f'{q["section_name"]} | {q["group_title"]} | {q["question_text"]}' for q in visible]
+    counts = {}
+    for label in labels:
+        counts[label] = counts.get(label, 0) + 1
+    return [
+        (int(q["id"]), label if counts[label] == 1 else f'{label} [#{q["id"]}]')
+        for q, label in zip(visible, labels)
+    ]
+
+def _norm_match(x) -> str:
+    """Normaliza texto para los match tolerantes (sin tildes, minúsculas, solo [a-z0-9])."""
+    import unicodedata as _ud
+    x = (x or "").lower().strip()
+    x = _ud.normalize("NFKD", x).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", "", x)
+
+def _decode_answer(qtype, value_text, value_bool, value_number, value_json):
+    """Valor legible de una respuesta (mismo criterio que export_answers_wide)."""
+    if qtype == "yes_no":
+        if value_bool is True:
+            return "Sí"
+        if value_bool is False:
+            return "No"
+    if value_text is not None:
+        return value_text
+    if value_number is not None:
+        return value_number
+    if value_json is not None:
+        if isinstance(value_json, str):
+            try:
+                return json.loads(value_json)
+            except Exception:
+                return value_json
+        return value_json
+    return None
+
+def _decode_answer_frame(df):
+    """Versión vectorizada de _decode_answer sobre un DataFrame de respuestas.
+
+    Prioridad: Sí/No (yes_no) > value_text > value_number > value_json.
+    """
+    ans = df["value_json"].astype(object)
+    is_str = ans.map(type).eq(str)
+    if is_str.any():
+        ans.loc[is_str] = ans.loc[is_str].map(lambda v: _decode_answer(None, None, None, None, v))
+    ans = ans.where(df["value_number"].isna(), df["value_number"].astype(object))
+    ans = ans.where(df["value_text"].isna(), df["value_text"])
+    yes_no = df["qtype"].eq("yes_no")
+    ans = ans.where(~(yes_no & df["value_bool"].eq(True)), "Sí")
+    ans = ans.where(~(yes_no & df["value_bool"].eq(False)), "No")
+    return ans.where(ans.notna(), None)
+
+def _question_frame(df, text_col: str):
+    """Textos normalizados por pregunta (no por respuesta).
+
+    Se calcula una vez por question_id y luego se mapea a las filas de respuestas.
+    """
+    qinfo = (
+        df[["question_id", "section_name", "group_title", text_col]]
+        .drop_duplicates("question_id")
+        .set_index("question_id")
+    )
+    qinfo["sec_n"] = qinfo["section_name"].map(_norm_match)
+    qinfo["grp_n"] = qinfo["group_title"].map(_norm_match)
+    qinfo["q_n"] = qinfo[text_col].map(_norm_match)
+    return qinfo
+
+# --- Tabla de resultados en formato ancho (materializada) ---
+# survey_results_wide tiene 1 fila por encuesta con las columnas clave (Provincia, Municipio,
+# identificación) ya resueltas y las respuestas decodificadas en `answers` ({question_id: valor}).
+# Se actualiza al guardar encuestas y se reconstruye cuando cambia el formulario (results_wide_state),
+# así la exportación es una lectura secuencial en vez de joins + pivot.
+
+WIDE_KEY_CODES = list(EXPORT_KEY_COLUMNS.keys())
+
+def add_results_wide():
+    """Migración: tablas survey_results_wide y results_wide_state."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS survey_results_wide (
+                response_id BIGINT PRIMARY KEY REFERENCES survey_responses(id) ON DELETE CASCADE,
+                version_id INTEGER NOT NULL REFERENCES survey_versions(id) ON DELETE CASCADE,
+                created_at TIMESTAMPTZ NOT NULL,
+                metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+                province TEXT NULL,
+                municipality TEXT NULL,
+                full_name TEXT NULL,
+                doc_type TEXT NULL,
+                doc_number TEXT NULL,
+                phone TEXT NULL,
+                email TEXT NULL,
+                role TEXT NULL,
+                answers JSONB NOT NULL DEFAULT '{}'::jsonb
+            );
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_results_wide_version ON survey_results_wide(version_id, response_id);")
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS results_wide_state (
+                version_id INTEGER PRIMARY KEY REFERENCES survey_versions(id) ON DELETE CASCADE,
+                is_stale BOOLEAN NOT NULL DEFAULT TRUE,
+                rebuilt_at TIMESTAMPTZ NULL
+            );
+            """)
+        conn.commit()
+
+class _WideRowBuilder:
+    """Resuelve columnas clave + respuestas de una encuesta según las preguntas de la versión."""
+
+    def __init__(self, qrows):
+        self.header_cols = export_question_header(qrows)
+        self.questions = {}
+        for q in qrows:
+            sec_n, grp_n, q_n = _norm_match(q["section_name"]), _norm_match(q["group_title"]), _norm_match(q["question_text"])
+            fallback = [
+                key for key, (sc, gc, qc) in EXPORT_KEY_MATCH.items()
+                if _norm_match(sc) in sec_n and _norm_match(gc) in grp_n and _norm_match(qc) in q_n
+            ]
+            self.questions[int(q["id"])] = {"qtype": q["qtype"], "code": q["code"], "fallback": fallback}
+
+    def qtype(self, question_id: int):
+        info = self.questions.get(int(question_id))
+        return info["qtype"] if info else None
+
+    def build(self, metadata, answers):
+        """answers: [(question_id, valor decodificado)]. Retorna (valores clave, doc de respuestas)."""
+        meta = metadata
+        if isinstance(meta, str):
+            try:
+                meta = json.loads(meta) if meta else {}
+            except Exception:
+                meta = {}
+        meta = meta or {}
+        by_code, by_match, doc = {}, {}, {}
+        for qid, ans in answers:
+            info = self.questions.get(int(qid))
+            if info is None or ans is None:
+                continue
+            doc.setdefault(str(qid), ans)
+            if info["code"] in EXPORT_KEY_COLUMNS:
+                by_code.setdefault(info["code"], ans)
+            for key in info["fallback"]:
+                by_match.setdefault(key, ans)
+        keys = []
+        for k in WIDE_KEY_CODES:
+            val = by_code.get(k)
+            if val is None:
+                val = next((meta[a] for a in EXPORT_META_ALIASES[k] if meta.get(a) not in (None, "")), None)
+            if val is None:
+                val = by_match.get(k)
+            keys.append(val)
+        return keys, doc
+
+def _wide_row(response_id, version_id, created_at, metadata, keys, doc):
+    """Tupla para INSERT en survey_results_wide."""
+    if not isinstance(metadata, str):
+        metadata = json.dumps(metadata or {}, default=str)
+    return (
+        (response_id, version_id, created_at, metadata)
+        + tuple(None if v is None else str(v) for v in keys)
+        + (json.dumps(doc, separators=(",", ":"), default=str),)
+    )
+
+_WIDE_UPSERT_SQL = f"""
+    INSERT INTO survey_results_wide(response_id, version_id, created_at, metadata, {", ".join(WIDE_KEY_CODES)}, answers)
+    VALUES %s
+    ON CONFLICT (response_id) DO UPDATE SET
+        created_at=EXCLUDED.created_at,
+        metadata=EXCLUDED.metadata,
+        {", ".join(f"{k}=EXCLUDED.{k}" for k in WIDE_KEY_CODES)},
+        answers=EXCLUDED.answers;
+"""
+
+def _iter_response_answers(conn, version_id: int, builder: _WideRowBuilder, chunk_size: int = 5000, response_ids=None):
+    """Genera (response_id, created_at, metadata, [(question_id, valor)]) leyendo con cursor de servidor."""
+    where = "r.version_id=%s"
+    params = [version_id]
+    if response_ids is not None:
+        where += " AND r.id = ANY(%s)"
+        params.append(list(response_ids))
+    with conn.cursor(name=f"wide_src_{version_id}_{threading.get_ident()}", cursor_factory=RealDictCursor) as cur:
+        cur.itersize = chunk_size
+        cur.execute(f"""
+            SELECT r.id AS response_id, r.created_at, r.metadata,
+                   a.question_id, a.value_text, a.value_bool, a.value_number, a.value_json
+            FROM survey_responses r
+            JOIN survey_answers_all a ON a.response_id = r.id
+            WHERE {where}
+            ORDER BY r.id;
+        """, params)
+        current = None
+        answers = []
+        for row in cur:
+            rid = int(row["response_id"])
+            if current is None or rid != current[0]:
+                if current is not None:
+                    yield current + (answers,)
+                current = (rid, row["created_at"], row["metadata"])
+                answers = []
+            qid = int(row["question_id"])
+            answers.append((
+                qid,
+                _decode_answer(builder.qtype(qid), row["value_text"], row["value_bool"], row["value_number"], row["value_json"]),
+            ))
+        if current is not None:
+            yield current + (answers,)
+
+@timed
+def rebuild_results_wide(version_id: int, response_ids=None, batch_size: int = 500) -> int:
+    """Reconstruye survey_results_wide (toda la versión, o solo `response_ids`).
+
+    La reconstrucción completa corre en una sola transacción (los lectores ven la tabla
+    anterior hasta el commit) y deja la versión marcada como al día.
+    """
+    builder = _WideRowBuilder(export_questions(version_id))
+    n = 0
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if response_ids is None:
+                cur.execute("DELETE FROM survey_results_wide WHERE version_id=%s;", (version_id,))
+            batch = []
+            for rid, created_at, metadata, answers in _iter_response_answers(conn, version_id, builder, response_ids=response_ids):
+                keys, doc = builder.build(metadata, answers)
+                batch.append(_wide_row(rid, version_id, created_at, metadata, keys, doc))
+                if len(batch) >= batch_size:
+                    execute_values(cur, _WIDE_UPSERT_SQL, batch, page_size=batch_size)
+                    n += len(batch)
+                    batch = []
+            if batch:
+                execute_values(cur, _WIDE_UPSERT_SQL, batch, page_size=batch_size)
+                n += len(batch)
+            if response_ids is None:
+                cur.execute(
+                    """
+                    INSERT INTO results_wide_state(version_id, is_stale, rebuilt_at) VALUES(%s, FALSE, NOW())
+                    ON CONFLICT (version_id) DO UPDATE SET is_stale=FALSE, rebuilt_at=NOW();
+                    """,
+                    (version_id,),
+                )
+        conn.commit()
+    return n
+
+def mark_results_wide_stale(version_id: int):
+    """Cambió algo que define las filas anchas (textos/codes/tipos de preguntas, metadata):
+    la próxima exportación reconstruye la tabla."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            _mark_results_wide_stale_in_tx(cur, version_id)
+
+def results_wide_is_fresh(version_id: int) -> bool:
+    row = fetchone("SELECT is_stale FROM results_wide_state WHERE version_id=%s;", (version_id,))
+    return bool(row) and not row["is_stale"]
+
+def ensure_results_wide(version_id: int):
+    if not results_wide_is_fresh(version_id):
+        rebuild_results_wide(version_id)
+
+def refresh_results_wide_rows(response_ids: list[int]):
+    """Actualiza las filas anchas de esas encuestas.
+
+    Se llama una vez por encuesta (no por respuesta). Escribe aunque la tabla esté
+    desactualizada, por la misma razón que _upsert_results_wide_in_tx.
+    """
+    if not response_ids:
+        return
+    rows = fetchall(
+        "SELECT DISTINCT version_id FROM survey_responses WHERE id = ANY(%s);",
+        (list(response_ids),),
+    )
+    for r in rows:
+        rebuild_results_wide(int(r["version_id"]), response_ids=response_ids)
+
+_WIDE_BUILDERS = {}
+
+def _upsert_results_wide_in_tx(conn, version_id: int, response_id: int, metadata: dict, decoded_answers):
+    """Escribe la fila ancha de una encuesta nueva dentro de la transacción de submit_response.
+
+    Se escribe siempre, aunque la tabla esté desactualizada: una reconstrucción completa solo
+    ve las encuestas confirmadas antes de empezar a leer, así que una enviada mientras corre
+    quedaría fuera de ambos caminos. Si la reconstrucción sí la ve, su upsert la sobrescribe.
+    El builder se cachea por form_revision (las preguntas no cambian sin subirla).
+    """
+    if not decoded_answers:
+        return
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT form_revision, NOW() AS now FROM survey_versions WHERE id=%s;", (version_id,))
+        state = cur.fetchone()
+        if not state:
+            return
+        cache_key = (version_id, state["form_revision"])
+        builder = _WIDE_BUILDERS.get(version_id)
+        if builder is None or builder[0] != cache_key:
+            cur.execute(_EXPORT_QUESTIONS_SQL, (version_id,))
+            builder = (cache_key, _WideRowBuilder(cur.fetchall()))
+            _WIDE_BUILDERS[version_id] = builder
+        keys, doc = builder[1].build(metadata, decoded_answers)
+        execute_values(cur, _WIDE_UPSERT_SQL, [_wide_row(response_id, version_id, state["now"], metadata, keys, doc)])
+
+def export_watermark(version_id: int) -> dict:
+    """Marca de agua de los datos exportables de una versión.
+
+    Cambia si llegan encuestas nuevas (max id), si se borran (conteo) o si la tabla ancha se
+    reconstruyó por cambios del formulario/repairs (rebuilt_at). Llamar después de
+    ensure_results_wide para que rebuilt_at esté al día.
+    """
+    row = fetchone(
+        """
+        SELECT COALESCE(MAX(r.id), 0) AS max_id, COUNT(*) AS n,
+               (SELECT rebuilt_at FROM results_wide_state WHERE version_id=%s) AS rebuilt_at,
+               (SELECT archived_at FROM survey_versions WHERE id=%s) AS archived_at
+        FROM survey_responses r
+        WHERE r.version_id=%s;
+        """,
+        (version_id, version_id, version_id),
+    )
+    return {
+        "version_id": int(version_id),
+        "max_id": int(row["max_id"]),
+        "n": int(row["n"]),
+        "rebuilt_at": row["rebuilt_at"].isoformat() if row["rebuilt_at"] else "",
+        "archived_at": row["archived_at"].isoformat() if row["archived_at"] else "",
+    }
+
+def _number_questions_with_text(version_id: int, question_ids) -> set[int]:
+    """Preguntas `number` con alguna respuesta que no es número (ej. "5 aprox.").
+
+    encode_answer guarda ese texto en value_text (JSONB: string) en lugar de descartarlo.
+    """
+    if not question_ids:
+        return set()
+    if is_version_archived(version_id):
+        rows = fetchall(
+            """
+            SELECT DISTINCT kv.key::int AS question_id
+            FROM survey_responses_archive a
+            CROSS JOIN LATERAL jsonb_each(a.answers) kv
+            WHERE a.version_id=%s AND kv.key = ANY(%s) AND jsonb_typeof(kv.value) = 'string';
+            """,
+            (version_id, [str(qid) for qid in question_ids]),
+        )
+    else:
+        rows = fetchall(
+            """
+            SELECT DISTINCT a.question_id
+            FROM survey_answers_all a
+            JOIN survey_responses r ON r.id = a.response_id
+            WHERE r.version_id=%s AND a.question_id = ANY(%s) AND a.value_text IS NOT NULL;
+            """,
+            (version_id, list(question_ids)),
+        )
+    return {int(r["question_id"]) for r in rows}
+
+def export_column_kinds(version_id: int) -> list[str]:
+    """Tipo lógico de cada columna de export_wide_rows (mismo orden que el header).
+
+    "int" | "datetime" | "json" | "text" | "bool" (yes_no) | "number" | "list" (multi_choice)
+    Una pregunta `number` con respuestas de texto libre sale como "text", para que
+    CSV/Parquet/Arrow conserven ese texto en lugar de dejar la celda vacía.
+    """
+    qrows = export_questions(version_id)
+    qtypes = {int(q["id"]): q["qtype"] for q in qrows}
+    header_cols = export_question_header(qrows)
+    kind_of = {"yes_no": "bool", "number": "number", "multi_choice": "list"}
+    free_text = _number_questions_with_text(
+        version_id, [qid for qid, _ in header_cols if qtypes[qid] == "number"]
+    )
+    return (
+        ["int", "datetime", "json"]
+        + ["text"] * len(WIDE_KEY_CODES)
+        + ["text" if qid in free_text else kind_of.get(qtypes[qid], "text") for qid, _ in header_cols]
+    )
+
+# Filtros de exportación (dict, todas las claves opcionales):
+#   date_from / date_to (datetime.date, inclusivos, en APP_TZ), province, municipality,
+#   surveyor (texto contenido en metadata.encuestador), id_from / id_to (inclusivos)
+#   no_municipality=True: solo encuestas sin municipio (lo usa el paquete por municipio)
+#   is_test=True / False: solo encuestas de prueba (metadata.is_test) / solo las reales
+# Todos se evalúan sobre survey_responses (province/municipality = columnas generadas desde
+# metadata) o, en versiones archivadas, sobre survey_responses_archive, que copia esas mismas
+# columnas. Así exportar, contar, borrar y archivar con los mismos filtros toca las mismas
+# encuestas, y nada de esto necesita la tabla ancha al día.
+EXPORT_FILTER_KEYS = (
+    "date_from", "date_to", "province", "municipality", "surveyor", "id_from", "id_to", "no_municipality", "is_test",
+)
+
+def _like_escape(text) -> str:
+    """Texto literal para un patrón LIKE/ILIKE con ESCAPE '\\' (% y _ no son comodines)."""
+    return str(text).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _export_filter_sql(version_id: int, filters: dict | None, alias: str = ""):
+    """WHERE (con parámetros) para los filtros dados.
+
+    Sirve para survey_responses y survey_responses_archive (id, version_id, created_at,
+    metadata, province, municipality). `alias`: prefijo de tabla cuando hay un JOIN (p. ej. "r").
+    """
+    filters = {k: v for k, v in (filters or {}).items() if v not in (None, "")}
+    unknown = set(filters) - set(EXPORT_FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Filtros no soportados: {', '.join(sorted(unknown))}")
+    c = f"{alias}." if alias else ""
+    tz = os.getenv("APP_TZ", "America/Bogota")
+    where = [f"{c}version_id=%s"]
+    params = [version_id]
+    if "date_from" in filters:
+        where.append(f"{c}created_at >= (%s::date)::timestamp AT TIME ZONE %s")
+        params += [filters["date_from"], tz]
+    if "date_to" in filters:
+        where.append(f"{c}created_at < ((%s::date) + 1)::timestamp AT TIME ZONE %s")
+        params += [filters["date_to"], tz]
+    if "province" in filters:
+        where.append(f"{c}province = %s")
+        params.append(filters["province"])
+    if "municipality" in filters:
+        where.append(f"{c}municipality = %s")
+        params.append(filters["municipality"])
+    if filters.get("no_municipality"):
+        where.append(f"{c}municipality IS NULL")
+    if "is_test" in filters:
+        where.append(f"COALESCE(({c}metadata ->> 'is_test')::boolean, FALSE) = %s")
+        params.append(bool(filters["is_test"]))
+    if "surveyor" in filters:
+        where.append(f"{c}metadata ->> 'encuestador' ILIKE %s ESCAPE '\\'")
+        params.append(f"%{_like_escape(filters['surveyor'])}%")
+    if "id_from" in filters:
+        where.append(f"{c}id >= %s")
+        params.append(int(filters["id_from"]))
+    if "id_to" in filters:
+        where.append(f"{c}id <= %s")
+        params.append(int(filters["id_to"]))
+    return " AND ".join(where), params
+
+def _filter_source(version_id: int) -> str:
+    """Tabla sobre la que se evalúan los filtros: survey_responses o el archivo."""
+    return "survey_responses_archive" if is_version_archived(version_id) else "survey_responses"
+
+def count_export_rows(version_id: int, filters: dict | None = None) -> int:
+    """Cuántas encuestas tendría el export con esos filtros (no reconstruye la tabla ancha)."""
+    table = _filter_source(version_id)
+    where, params = _export_filter_sql(version_id, filters)
+    row = fetchone(f"SELECT COUNT(*) AS n FROM {table} WHERE {where};", params)
+    return int(row["n"])
+
+def export_partitions(version_id: int, filters: dict | None = None):
+    """Provincia/municipio con conteo y rango de fechas, para partir el export por municipio."""
+    table = _filter_source(version_id)
+    where, params = _export_filter_sql(version_id, filters)
+    return fetchall(
+        f"""
+        SELECT province, municipality, COUNT(*) AS n,
+               MIN(created_at) AS first_at, MAX(created_at) AS last_at
+        FROM {table}
+        WHERE {where}
+        GROUP BY province, municipality
+        ORDER BY province NULLS LAST, municipality NULLS LAST;
+        """,
+        params,
+    )
+
+def export_filter_options(version_id: int) -> dict:
+    """Valores disponibles para los filtros de provincia/municipio (no reconstruye la tabla ancha)."""
+    if is_version_archived(version_id):
+        rows = fetchall(
+            """
+            SELECT DISTINCT province, municipality
+            FROM survey_responses_archive
+            WHERE version_id=%s
+            ORDER BY province NULLS LAST, municipality NULLS LAST;
+            """,
+            (version_id,),
+        )
+    else:
+        rows = response_locations(version_id)
+    provinces, municipalities = {}, {}
+    for r in rows:
+        if r["province"]:
+            provinces.setdefault(r["province"], None)
+            if r["municipality"]:
+                municipalities.setdefault(r["province"], []).append(r["municipality"])
+    return {"provinces": list(provinces), "municipalities": municipalities}
+
+def export_wide_rows(version_id: int, chunk_size: int = 5000, filters: dict | None = None):
+    """Versión streaming de export_answers_wide: retorna (header, iterador de filas).
+
+    Lee survey_results_wide (reconstruyéndola si el formulario cambió) con un cursor de
+    servidor de a `chunk_size` filas: la memoria no crece con el número de encuestas.
+    Mismas columnas y reglas que export_answers_wide. `filters` (ver EXPORT_FILTER_KEYS)
+    se aplica en el WHERE sobre survey_responses, así solo se leen las filas del recorte.
+    Las versiones archivadas se leen de survey_responses_archive (ver archive_version).
+    """
+    archived = is_version_archived(version_id)
+    if not archived:
+        ensure_results_wide(version_id)
+    qrows = export_questions(version_id)
+    header_cols = export_question_header(qrows)
+    qkeys = [str(qid) for qid, _ in header_cols]
+    header = (
+        ["response_id", "created_at", "metadata"]
+        + [EXPORT_KEY_COLUMNS[k] for k in WIDE_KEY_CODES]
+        + [label for _, label in header_cols]
+    )
+    if archived:
+        where, params = _export_filter_sql(version_id, filters)
+        return header, _archived_wide_rows(version_id, _WideRowBuilder(qrows), qkeys, where, params, chunk_size)
+    where, params = _export_filter_sql(version_id, filters, alias="r")
+
+    def _rows():
+        with get_conn() as conn:
+            with conn.cursor(name=f"export_wide_{version_id}_{threading.get_ident()}", cursor_factory=RealDictCursor) as cur:
+                cur.itersize = chunk_size
+                cur.execute(f"""
+                    SELECT w.response_id, w.created_at, w.metadata, {", ".join(f"w.{k}" for k in WIDE_KEY_CODES)}, w.answers
+                    FROM survey_responses r
+                    JOIN survey_results_wide w ON w.response_id = r.id
+                    WHERE {where}
+                    ORDER BY r.id;
+                """, params)
+                for row in cur:
+                    answers = row["answers"] or {}
+                    yield (
+                        [int(row["response_id"]), row["created_at"], row["metadata"]]
+                        + [row[k] for k in WIDE_KEY_CODES]
+                        + [answers.get(k) for k in qkeys]
+                    )
+
+    return header, _rows()
+
+# --- Archivo de versiones cerradas ---
+# Al archivar, las encuestas de una versión inactiva salen de las tablas "calientes"
+# (survey_responses / survey_answers / survey_results_wide y sus índices) y quedan en
+# survey_responses_archive: una fila por encuesta con las respuestas en JSONB, con el mismo
+# formato que ANSWERS_STORAGE=jsonb, comprimido por TOAST (lz4 si el servidor lo soporta).
+# La exportación lee el archivo directamente; la tabla ancha se arma al vuelo.
+
+def add_responses_archive():
+    """Migración: tabla survey_responses_archive + survey_versions.archived_at."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE survey_versions ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ NULL;")
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS survey_responses_archive (
+                id BIGINT PRIMARY KEY,
+                version_id INTEGER NOT NULL REFERENCES survey_versions(id) ON DELETE CASCADE,
+                created_at TIMESTAMPTZ NOT NULL,
+                metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+                province TEXT NULL,
+                municipality TEXT NULL,
+                answers JSONB NOT NULL DEFAULT '{}'::jsonb
+            );
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_archive_version ON survey_responses_archive(version_id, id);")
+            cur.execute("""
+            DO $$
+            BEGIN
+                IF current_setting('server_version_num')::int >= 140000 THEN
+                    EXECUTE 'ALTER TABLE survey_responses_archive ALTER COLUMN answers SET COMPRESSION lz4';
+                    EXECUTE 'ALTER TABLE survey_responses_archive ALTER COLUMN metadata SET COMPRESSION lz4';
+                END IF;
+            EXCEPTION WHEN OTHERS THEN
+                -- Postgres compilado sin lz4: queda la compresión por defecto (pglz)
+                NULL;
+            END $$;
+            """)
+        conn.commit()
+
+def is_version_archived(version_id: int) -> bool:
+    row = fetchone("SELECT archived_at FROM survey_versions WHERE id=%s;", (version_id,))
+    return bool(row) and row["archived_at"] is not None
+
+def list_versions():
+    """Versiones con su estado y conteo de encuestas (activas + archivadas)."""
+    return fetchall(
+        """
+        SELECT v.id, v.name, v.is_active, v.created_at, v.archived_at,
+               (SELECT COUNT(*) FROM survey_responses r WHERE r.version_id = v.id) AS n_live,
+               (SELECT COUNT(*) FROM survey_responses_archive a WHERE a.version_id = v.id) AS n_archived
+        FROM survey_versions v
+        ORDER BY v.id DESC;
+        """
+    )
+
+@timed
+def archive_version(version_id: int, batch_size: int = 500, progress=None) -> int:
+    """Mueve las encuestas de una versión cerrada (inactiva) a survey_responses_archive.
+
+    Por lotes de `batch_size`, cada uno en su transacción: copiar al archivo y borrar de
+    survey_responses (la cascada limpia survey_answers y survey_results_wide). Se puede
+    reintentar si se interrumpe. Al terminar marca la versión como archivada y corre
+    maintenance_after_delete (ANALYZE; VACUUM en segundo plano). Retorna cuántas encuestas se archivaron.
+    """
+    v = fetchone("SELECT is_active FROM survey_versions WHERE id=%s;", (version_id,))
+    if not v:
+        raise ValueError(f"No existe la versión {version_id}.")
+    if v["is_active"]:
+        raise ValueError("Solo se pueden archivar versiones cerradas (inactivas).")
+    total = count_responses(version_id)
+    done = 0
+    while True:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id FROM survey_responses WHERE version_id=%s ORDER BY id LIMIT %s FOR UPDATE;",
+                    (version_id, batch_size),
+                )
+                batch = [r[0] for r in cur.fetchall()]
+                if not batch:
+                    break
+                # Mismo valor tipado que guarda ANSWERS_STORAGE=jsonb (_answer_json_value), así
+                # el export de una versión archivada coincide con el de la versión viva.
+                cur.execute(
+                    """
+                    SELECT a.response_id, a.question_id, q.qtype,
+                           a.value_text, a.value_bool, a.value_number, a.value_json
+                    FROM survey_answers_all a
+                    LEFT JOIN questions q ON q.id = a.question_id
+                    WHERE a.response_id = ANY(%s);
+                    """,
+                    (batch,),
+                )
+                docs = {}
+                for rid, qid, qtype, value_text, value_bool, value_number, value_json in cur.fetchall():
+                    encoded = (value_text, value_bool, value_number, None if value_json is None else json.dumps(value_json))
+                    value = _answer_json_value(qtype, encoded)
+                    if value is not None:
+                        docs.setdefault(str(rid), {})[str(qid)] = value
+                cur.execute(
+                    """
+                    INSERT INTO survey_responses_archive(id, version_id, created_at, metadata, province, municipality, answers)
+                    SELECT r.id, r.version_id, r.created_at, r.metadata, r.province, r.municipality,
+                           COALESCE(d.doc, '{}'::jsonb)
+                    FROM survey_responses r
+                    LEFT JOIN jsonb_each(%s::jsonb) AS d(response_id, doc) ON d.response_id = r.id::text
+                    WHERE r.id = ANY(%s)
+                    ON CONFLICT (id) DO NOTHING;
+                    """,
+                    (json.dumps(docs, separators=(",", ":"), default=str), batch),
+                )
+                cur.execute("DELETE FROM survey_responses WHERE id = ANY(%s);", (batch,))
+        done += len(batch)
+        if progress:
+            progress(done, max(total, done))
+    execute("UPDATE survey_versions SET archived_at=NOW() WHERE id=%s;", (version_id,))
+    log.info("archived %s responses of version %s", done, version_id)
+    if done:
+        maintenance_after_delete()
+    return done
+
+def _decode_archived(qtype, value):
+    """Valor legible de una respuesta guardada en JSONB (archivo / ANSWERS_STORAGE=jsonb)."""
+    if isinstance(value, bool):
+        return _decode_answer(qtype, None, value, None, None)
+    if isinstance(value, str):
+        return _decode_answer(qtype, value, None, None, None)
+    if isinstance(value, (int, float)):
+        return _decode_answer(qtype, None, None, value, None)
+    return _decode_answer(qtype, None, None, None, value)
+
+def _archived_wide_rows(version_id: int, builder, qkeys, where: str, params, chunk_size: int):
+    """Filas del export (mismo formato que export_wide_rows) armadas desde el archivo."""
+    with get_conn() as conn:
+        with conn.cursor(name=f"export_archive_{version_id}_{threading.get_ident()}", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = chunk_size
+            cur.execute(f"""
+                SELECT id, created_at, metadata, answers
+                FROM survey_responses_archive
+                WHERE {where}
+                ORDER BY id;
+            """, params)
+            for row in cur:
+                answers = [
+                    (int(qid), _decode_archived(builder.qtype(qid), v))
+                    for qid, v in (row["answers"] or {}).items()
+                ]
+                keys, doc = builder.build(row["metadata"], answers)
+                yield (
+                    [int(row["id"]), row["created_at"], row["metadata"]]
+                    + [None if v is None else str(v) for v in keys]
+                    + [doc.get(k) for k in qkeys]
+                )
+
 # --- CRUD básicos (secciones/grupos/preguntas/opciones) ---
 
+def list_sections(version_id: int):
+    """Todas las secciones de la versión (activas o no)."""
+    return fetchall("SELECT id, name, sort_order, is_active FROM sections WHERE version_id=%s ORDER BY sort_order, id;", (version_id,))
+
+# --- Programas contratados por municipio (ver programs.py) ---
+
+def add_municipality_sections():
+    """Migración: tabla municipality_sections (municipio normalizado -> sección habilitada)."""
+    execute("""
+    CREATE TABLE IF NOT EXISTS municipality_sections (
+        municipality_norm TEXT NOT NULL,
+        section_id INTEGER NOT NULL REFERENCES sections(id) ON DELETE CASCADE,
+        municipality TEXT NOT NULL,
+        PRIMARY KEY (municipality_norm, section_id)
+    );
+    """)
+    execute("CREATE INDEX IF NOT EXISTS idx_municipality_sections_section ON municipality_sections(section_id);")
+
+def municipality_sections(version_id: int):
+    """Filas (municipality_norm, municipality, section_id, section_name) de la versión."""
+    return fetchall(
+        """
+        SELECT m.municipality_norm, m.municipality, m.section_id, s.name AS section_name
+        FROM municipality_sections m
+        JOIN sections s ON s.id = m.section_id
+        WHERE s.version_id=%s
+        ORDER BY m.municipality_norm, s.sort_order, s.id;
+        """,
+        (version_id,),
+    )
+
+def replace_municipality_sections(version_id: int, rows):
+    """Reemplaza (en una transacción) la relación de la versión. rows: [(norm, nombre, section_id)]."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM municipality_sections WHERE section_id IN (SELECT id FROM sections WHERE version_id=%s);",
+                (version_id,),
+            )
+            if rows:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO municipality_sections(municipality_norm, municipality, section_id) VALUES %s
+                    ON CONFLICT (municipality_norm, section_id) DO NOTHING;
+                    """,
+                    list(rows),
+                )
+            # Nueva revisión: forms.py recarga la relación en todos los procesos (no afecta
+            # la tabla ancha)
+            rev = _bump_form_revision_in_tx(cur, version_id)
+    _remember_form_revision(version_id, rev)
+
+# Las funciones CRUD suben form_revision una vez por guardado, en la misma transacción.
+# La tabla ancha solo se marca para recalcular si cambia algo que usa _WideRowBuilder:
+# nombre de sección, título de grupo, enunciado/code/tipo de pregunta o su ubicación.
+# Orden, activo/inactivo, ayuda, config y opciones no cambian las filas ya calculadas.
+
 def upsert_section(version_id: int, section_id, name: str, sort_order: int, is_active: bool):
-    if section_id:
-        execute("UPDATE sections SET name=%s, sort_order=%s, is_active=%s WHERE id=%s AND version_id=%s;",
-                (name, sort_order, is_active, section_id, version_id))
-    else:
-        execute("INSERT INTO sections(version_id,name,sort_order,is_active) VALUES(%s,%s,%s,%s);",
-                (version_id, name, sort_order, is_active))
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            stale = False
+            if section_id:
+                cur.execute(
+                    """
+                    UPDATE sections s SET name=%s, sort_order=%s, is_active=%s
+                    FROM (SELECT id, name FROM sections WHERE id=%s) old
+                    WHERE s.id = old.id AND s.version_id=%s
+                    RETURNING old.name IS DISTINCT FROM s.name;
+                    """,
+                    (name, sort_order, is_active, section_id, version_id),
+                )
+                row = cur.fetchone()
+                stale = bool(row and row[0])
+            else:
+                cur.execute("INSERT INTO sections(version_id,name,sort_order,is_active) VALUES(%s,%s,%s,%s);",
+                            (version_id, name, sort_order, is_active))
+            rev = _bump_form_revision_in_tx(cur, version_id)
+            if stale:
+                _mark_results_wide_stale_in_tx(cur, version_id)
+    _remember_form_revision(version_id, rev)
 
 def upsert_group(version_id: int, group_id, section_id: int, title: str, sort_order: int, is_active: bool):
-    if group_id:
-        execute("UPDATE question_groups SET section_id=%s, title=%s, sort_order=%s, is_active=%s WHERE id=%s AND version_id=%s;",
-                (section_id, title, sort_order, is_active, group_id, version_id))
-    else:
-        execute("INSERT INTO question_groups(version_id,section_id,title,sort_order,is_active) VALUES(%s,%s,%s,%s,%s);",
-                (version_id, section_id, title, sort_order, is_active))
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            stale = False
+            if group_id:
+                cur.execute(
+                    """
+                    UPDATE question_groups g SET section_id=%s, title=%s, sort_order=%s, is_active=%s
+                    FROM (SELECT id, section_id, title FROM question_groups WHERE id=%s) old
+                    WHERE g.id = old.id AND g.version_id=%s
+                    RETURNING (old.section_id, old.title) IS DISTINCT FROM (g.section_id, g.title);
+                    """,
+                    (section_id, title, sort_order, is_active, group_id, version_id),
+                )
+                row = cur.fetchone()
+                stale = bool(row and row[0])
+            else:
+                cur.execute("INSERT INTO question_groups(version_id,section_id,title,sort_order,is_active) VALUES(%s,%s,%s,%s,%s);",
+                            (version_id, section_id, title, sort_order, is_active))
+            rev = _bump_form_revision_in_tx(cur, version_id)
+            if stale:
+                _mark_results_wide_stale_in_tx(cur, version_id)
+    _remember_form_revision(version_id, rev)
 
 def upsert_question(
     version_id: int,
@@ -1184,51 +2673,94 @@ def upsert_question(
     is_active: bool,
     config: dict,
 ):
-    if question_id:
-        execute(
-            """UPDATE questions
-               SET group_id=%s, code=%s, label=%s, text=%s, help_text=%s,
-                   qtype=%s, required=%s, sort_order=%s, is_active=%s, config=%s
-               WHERE id=%s AND version_id=%s;""",
-            (
-                group_id,
-                code or None,
-                label,
-                text,
-                help_text,
-                qtype,
-                required,
-                sort_order,
-                is_active,
-                json.dumps(config or {}),
-                question_id,
-                version_id,
-            ),
-        )
-    else:
-        execute(
-            """INSERT INTO questions(
-                   version_id,group_id,code,label,text,help_text,qtype,required,sort_order,is_active,config
-               )
-               VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);""",
-            (
-                version_id,
-                group_id,
-                code or None,
-                label,
-                text,
-                help_text,
-                qtype,
-                required,
-                sort_order,
-                is_active,
-                json.dumps(config or {}),
-            ),
-        )
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            stale = False
+            if question_id:
+                cur.execute(
+                    """UPDATE questions q
+                       SET group_id=%s, code=%s, label=%s, text=%s, help_text=%s,
+                           qtype=%s, required=%s, sort_order=%s, is_active=%s, config=%s
+                       FROM (SELECT id, group_id, code, label, text, qtype FROM questions WHERE id=%s) old
+                       WHERE q.id = old.id AND q.version_id=%s
+                       RETURNING (old.group_id, old.code, old.label, old.text, old.qtype)
+                                 IS DISTINCT FROM (q.group_id, q.code, q.label, q.text, q.qtype);""",
+                    (
+                        group_id,
+                        code or None,
+                        label,
+                        text,
+                        help_text,
+                        qtype,
+                        required,
+                        sort_order,
+                        is_active,
+                        json.dumps(config or {}),
+                        question_id,
+                        version_id,
+                    ),
+                )
+                row = cur.fetchone()
+                stale = bool(row and row[0])
+            else:
+                # Pregunta nueva: aún no tiene respuestas, la tabla ancha sigue válida
+                cur.execute(
+                    """INSERT INTO questions(
+                           version_id,group_id,code,label,text,help_text,qtype,required,sort_order,is_active,config
+                       )
+                       VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);""",
+                    (
+                        version_id,
+                        group_id,
+                        code or None,
+                        label,
+                        text,
+                        help_text,
+                        qtype,
+                        required,
+                        sort_order,
+                        is_active,
+                        json.dumps(config or {}),
+                    ),
+                )
+            rev = _bump_form_revision_in_tx(cur, version_id)
+            if stale:
+                _mark_results_wide_stale_in_tx(cur, version_id)
+    _remember_form_revision(version_id, rev)
+
+def replace_options(version_id: int, options_by_question: dict):
+    """Reemplaza las opciones de una o varias preguntas en una transacción (una sola revisión).
+
+    options_by_question: {question_id: [(etiqueta, valor, meta)]} en el orden a guardar.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            ids = [int(qid) for qid in options_by_question]
+            cur.execute("DELETE FROM question_options WHERE question_id = ANY(%s);", (ids,))
+            rows = [
+                (int(qid), label, value, idx, json.dumps(meta or {}))
+                for qid, opts in options_by_question.items()
+                for idx, (label, value, meta) in enumerate(opts, start=1)
+            ]
+            if rows:
+                execute_values(
+                    cur,
+                    "INSERT INTO question_options(question_id,label,value,sort_order,meta) VALUES %s;",
+                    rows,
+                )
+            rev = _bump_form_revision_in_tx(cur, version_id)
+    _remember_form_revision(version_id, rev)
 
 def delete_options_for_question(question_id: int):
     execute("DELETE FROM question_options WHERE question_id=%s;", (question_id,))
+    version_id = _question_version(question_id)
+    if version_id:
+        bump_form_revision(version_id)
 
 def insert_option(question_id: int, label: str, value: str, sort_order: int, meta: dict):
+    """Una opción suelta (para varias, replace_options: una transacción y una revisión)."""
     execute("INSERT INTO question_options(question_id,label,value,sort_order,meta) VALUES(%s,%s,%s,%s,%s);",
-            (question_id, label, value, sort_order, json.dumps(meta or {})))
\ No newline at end of file
+            (question_id, label, value, sort_order, json.dumps(meta or {})))
+    version_id = _question_version(question_id)
+    if version_id:
+        bump_form_revision(version_id)
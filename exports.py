@@ -0,0 +1,518 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import datetime
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+import db
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _xlsx_value(v):
+    """Valor apto para una celda de Excel (sin timezone, sin listas/dicts, sin caracteres ilegales)."""
+    if isinstance(v, datetime.datetime) and v.tzinfo is not None:
+        return v.replace(tzinfo=None)
+    if isinstance(v, (list, tuple)):
+        return ", ".join(str(x) for x in v)
+    if isinstance(v, dict):
+        return json.dumps(v, ensure_ascii=False, default=str)
+    if isinstance(v, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", v)
+    return v
+
+
+def _progress_every(progress, total: int, every: int = 500):
+    """Envuelve el callback progress(hechas, total) para llamarlo cada `every` filas."""
+    def tick(done: int, final: bool = False):
+        if progress and (final or done % every == 0):
+            progress(done, max(total, done))
+    return tick
+
+
+def write_xlsx(version_id: int, path: str | None = None, chunk_size: int = 5000, progress=None, filters=None) -> str:
+    """Exporta la versión a un .xlsx en disco (formato ancho) y retorna la ruta.
+
+    Usa el modo write-only de openpyxl (escribe fila a fila a disco) sobre
+    db.export_wide_rows, así la memoria no depende del número de encuestas.
+    `progress(hechas, total)` se llama periódicamente si se pasa. `filters`: ver
+    db.EXPORT_FILTER_KEYS (se aplican en SQL).
+    """
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="respuestas_", suffix=".xlsx")
+        os.close(fd)
+    header, rows = db.export_wide_rows(version_id, chunk_size=chunk_size, filters=filters)
+    tick = _progress_every(progress, db.count_export_rows(version_id, filters) if progress else 0)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("respuestas")
+    ws.append(header)
+    done = 0
+    for row in rows:
+        ws.append([_xlsx_value(v) for v in row])
+        done += 1
+        tick(done)
+    wb.save(path)
+    tick(done, final=True)
+    return path
+
+
+def _typed_value(kind: str, v):
+    """Valor tipado para CSV/Parquet/Arrow según el tipo de columna (ver db.export_column_kinds)."""
+    if v is None:
+        return None
+    if kind == "bool":
+        return True if v in ("Sí", True) else False if v in ("No", False) else None
+    if kind == "number":
+        # Las columnas con texto libre ya salen como "text" (db.export_column_kinds); aquí
+        # solo llega texto si se guardó después de calcular los tipos de esta exportación
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+    if kind == "list":
+        return [str(x) for x in v] if isinstance(v, (list, tuple)) else [str(v)]
+    if kind == "json":
+        return v if isinstance(v, str) else json.dumps(v, ensure_ascii=False, default=str)
+    if kind == "text":
+        return v if isinstance(v, str) else str(v)
+    return v
+
+
+def write_csv_gz(version_id: int, path: str | None = None, chunk_size: int = 5000, progress=None, filters=None) -> str:
+    """CSV (UTF-8, comprimido con gzip). Listas de selección múltiple como JSON."""
+    import csv
+    import gzip
+
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="respuestas_", suffix=".csv.gz")
+        os.close(fd)
+    kinds = db.export_column_kinds(version_id)
+    header, rows = db.export_wide_rows(version_id, chunk_size=chunk_size, filters=filters)
+    tick = _progress_every(progress, db.count_export_rows(version_id, filters) if progress else 0)
+    done = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        for row in rows:
+            out = []
+            for kind, v in zip(kinds, row):
+                v = _typed_value(kind, v)
+                if isinstance(v, list):
+                    v = json.dumps(v, ensure_ascii=False)
+                elif isinstance(v, datetime.datetime):
+                    v = v.isoformat()
+                out.append(v)
+            w.writerow(out)
+            done += 1
+            tick(done)
+    tick(done, final=True)
+    return path
+
+
+def _arrow_schema(header, kinds):
+    import pyarrow as pa
+
+    types = {
+        "int": pa.int64(),
+        "datetime": pa.timestamp("us", tz="UTC"),
+        "json": pa.string(),
+        "text": pa.string(),
+        "bool": pa.bool_(),
+        "number": pa.float64(),
+        "list": pa.list_(pa.string()),
+    }
+    # Arrow/Parquet aceptan nombres de columna repetidos, pero pandas y la mayoría de
+    # herramientas que leen el archivo seleccionan por nombre: export_question_header los evita.
+    return pa.schema([pa.field(name, types[kind]) for name, kind in zip(header, kinds)])
+
+
+def _arrow_batches(version_id: int, chunk_size: int, progress, filters=None):
+    """(schema, generador de RecordBatch de `chunk_size` filas) sobre db.export_wide_rows."""
+    import pyarrow as pa
+
+    kinds = db.export_column_kinds(version_id)
+    header, rows = db.export_wide_rows(version_id, chunk_size=chunk_size, filters=filters)
+    schema = _arrow_schema(header, kinds)
+    tick = _progress_every(progress, db.count_export_rows(version_id, filters) if progress else 0, every=chunk_size)
+
+    def _batches():
+        done = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            cols = [[_typed_value(kind, r[i]) for r in chunk] for i, kind in enumerate(kinds)]
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(c, type=schema.field(i).type) for i, c in enumerate(cols)],
+                schema=schema,
+            )
+            done += len(chunk)
+            tick(done)
+        tick(done, final=True)
+
+    return schema, _batches()
+
+
+def write_parquet(version_id: int, path: str | None = None, chunk_size: int = 5000, progress=None, filters=None) -> str:
+    """Parquet con columnas tipadas (un row group por bloque de `chunk_size` encuestas)."""
+    import pyarrow.parquet as pq
+
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="respuestas_", suffix=".parquet")
+        os.close(fd)
+    schema, batches = _arrow_batches(version_id, chunk_size, progress, filters)
+    with pq.ParquetWriter(path, schema, compression="zstd") as w:
+        for batch in batches:
+            w.write_batch(batch)
+    return path
+
+
+def write_arrow(version_id: int, path: str | None = None, chunk_size: int = 5000, progress=None, filters=None) -> str:
+    """Archivo Arrow IPC (Feather v2) con columnas tipadas."""
+    import pyarrow as pa
+
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="respuestas_", suffix=".arrow")
+        os.close(fd)
+    schema, batches = _arrow_batches(version_id, chunk_size, progress, filters)
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as w:
+            for batch in batches:
+                w.write_batch(batch)
+    return path
+
+
+# --- Paquete por municipio (zip con un archivo por municipio + índice) ---
+# Cada municipio se escribe en un proceso aparte (pool "spawn": cada proceso abre su propio
+# pool de conexiones) y lee solo sus filas (índice de municipio de survey_responses + la fila
+# ancha de cada encuesta), en vez de recalcular el export completo una vez por municipio.
+
+def _bundle_name(municipality) -> str:
+    raw = municipality or "SIN_MUNICIPIO"
+    raw = unicodedata.normalize("NFKD", raw).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^A-Za-z0-9]+", "_", raw).strip("_").upper() or "SIN_NOMBRE"
+
+
+def _bundle_part(version_id: int, fmt: str, path: str, filters: dict) -> str:
+    """Worker del pool de procesos: escribe el archivo de un municipio."""
+    return FORMATS[fmt][1](version_id, path, filters=filters)
+
+
+def _bundle_index(parts) -> str:
+    """Hoja índice del paquete: un renglón por archivo."""
+    fd, path = tempfile.mkstemp(prefix="indice_", suffix=".xlsx")
+    os.close(fd)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("indice")
+    ws.append(["archivo", "provincia", "municipio", "encuestas", "primera", "ultima"])
+    for p in parts:
+        ws.append([
+            p["file"], p["province"], p["municipality"], int(p["n"]),
+            _xlsx_value(p["first_at"]), _xlsx_value(p["last_at"]),
+        ])
+    ws.append([])
+    ws.append(["TOTAL", None, None, sum(int(p["n"]) for p in parts)])
+    wb.save(path)
+    return path
+
+
+def write_bundle(version_id: int, path: str | None = None, chunk_size: int = 5000, progress=None,
+                 filters=None, part_fmt: str = "xlsx") -> str:
+    """Zip con un archivo `part_fmt` por municipio y un indice.xlsx con los conteos.
+
+    Los municipios se generan en paralelo (EXPORT_BUNDLE_PROCESSES procesos). Se respetan
+    los demás filtros (fecha, encuestador...). `progress` avanza por municipio terminado.
+    """
+    import zipfile
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="respuestas_municipios_", suffix=".zip")
+        os.close(fd)
+    filters = _clean_filters(filters)
+    # Un archivo por municipio (las encuestas sin municipio van juntas en SIN_MUNICIPIO)
+    merged = {}
+    for r in db.export_partitions(version_id, filters):
+        p = merged.setdefault(r["municipality"], {
+            "municipality": r["municipality"], "provinces": [], "n": 0, "first_at": None, "last_at": None,
+        })
+        if r["province"] and r["province"] not in p["provinces"]:
+            p["provinces"].append(r["province"])
+        p["n"] += int(r["n"])
+        p["first_at"] = min(x for x in (p["first_at"], r["first_at"]) if x is not None)
+        p["last_at"] = max(x for x in (p["last_at"], r["last_at"]) if x is not None)
+    parts = list(merged.values())
+    ext = FORMATS[part_fmt][2]
+    used = set()
+    for p in parts:
+        p["province"] = ", ".join(p["provinces"]) or None
+        name = _bundle_name(p["municipality"])
+        base, i = name, 2
+        while name in used:
+            name, i = f"{base}_{i}", i + 1
+        used.add(name)
+        p["file"] = f"{name}.{ext}"
+        if p["municipality"]:
+            p["filters"] = dict(filters, municipality=p["municipality"])
+        else:
+            p["filters"] = dict(filters, no_municipality=True)
+
+    workdir = tempfile.mkdtemp(prefix="bundle_")
+    tick = _progress_every(progress, len(parts), every=1)
+    try:
+        workers = int(os.getenv("EXPORT_BUNDLE_PROCESSES", str(min(4, os.cpu_count() or 1))))
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [
+                pool.submit(_bundle_part, version_id, part_fmt, os.path.join(workdir, p["file"]), p["filters"])
+                for p in parts
+            ]
+            for done, fut in enumerate(as_completed(futures), start=1):
+                fut.result()
+                tick(done)
+        index = _bundle_index(parts)
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.write(index, "indice.xlsx")
+            os.remove(index)
+            for p in parts:
+                zf.write(os.path.join(workdir, p["file"]), p["file"])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    tick(len(parts), final=True)
+    return path
+
+
+def write_bundle_csv(version_id: int, path: str | None = None, chunk_size: int = 5000, progress=None, filters=None) -> str:
+    """Como write_bundle, con un CSV comprimido por municipio."""
+    return write_bundle(version_id, path, chunk_size, progress, filters, part_fmt="csv.gz")
+
+
+# Formatos disponibles: clave -> (etiqueta, writer, extensión, mime)
+FORMATS = {
+    "xlsx": ("Excel (.xlsx)", write_xlsx, "xlsx", XLSX_MIME),
+    "csv.gz": ("CSV comprimido (.csv.gz)", write_csv_gz, "csv.gz", "application/gzip"),
+    "parquet": ("Parquet (.parquet)", write_parquet, "parquet", "application/vnd.apache.parquet"),
+    "arrow": ("Arrow IPC (.arrow)", write_arrow, "arrow", "application/vnd.apache.arrow.file"),
+    "zip-xlsx": ("Un Excel por municipio (.zip)", write_bundle, "zip", "application/zip"),
+    "zip-csv": ("Un CSV por municipio (.zip)", write_bundle_csv, "zip", "application/zip"),
+}
+
+
+def export_file(version_id: int, fmt: str = "xlsx", path: str | None = None, progress=None, filters=None) -> str:
+    """API programática: escribe el export `fmt` (ver FORMATS) y retorna la ruta.
+
+    `filters` (dict, ver db.EXPORT_FILTER_KEYS) recorta por fecha, provincia, municipio,
+    encuestador o rango de ids, p. ej. {"municipality": "Tunja", "date_from": date(2025, 3, 1)}.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Formato no soportado: {fmt} (opciones: {', '.join(FORMATS)})")
+    return FORMATS[fmt][1](version_id, path, progress=progress, filters=filters)
+
+
+def preview(version_id: int, n: int = 20, filters=None):
+    """Primeras `n` filas del export (header, filas) sin leer todo."""
+    header, rows = db.export_wide_rows(version_id, chunk_size=max(n, 100), filters=filters)
+    try:
+        first = list(islice(rows, n))
+    finally:
+        rows.close()
+    return header, first
+
+
+# --- Caché en disco de archivos exportados ---
+# Clave: versión + marca de agua de los datos (max id, conteo, reconstrucción de la tabla ancha).
+# Una encuesta nueva, un borrado o un cambio del formulario cambian la clave, así que las
+# entradas viejas simplemente dejan de usarse y el LRU las elimina.
+
+# Un lock por clave: dos pedidos del mismo archivo esperan al primero, pero exportaciones
+# distintas (otro formato, filtros o versión) corren en paralelo.
+_cache_locks = weakref.WeakValueDictionary()
+_cache_locks_guard = threading.Lock()
+
+
+def _key_lock(key: str) -> threading.Lock:
+    with _cache_locks_guard:
+        lock = _cache_locks.get(key)
+        if lock is None:
+            lock = _cache_locks[key] = threading.Lock()
+        return lock
+
+
+def _cache_dir() -> str:
+    d = os.getenv("EXPORT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "encuesta_export_cache")
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def _cache_max_bytes() -> int:
+    return int(float(os.getenv("EXPORT_CACHE_MAX_MB", "200")) * 1024 * 1024)
+
+
+def _clean_filters(filters) -> dict:
+    """Filtros sin valores vacíos (para que {} y {"province": None} compartan entrada)."""
+    return {k: v for k, v in (filters or {}).items() if v not in (None, "")}
+
+
+def _cache_key(watermark: dict, fmt: str, filters=None) -> str:
+    raw = json.dumps(watermark, sort_keys=True) + "|" + fmt
+    if filters:
+        raw += "|" + json.dumps(filters, sort_keys=True, default=str)
+    return f"v{watermark['version_id']}_" + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _evict(keep=()):
+    """LRU: borra los archivos usados hace más tiempo hasta quedar bajo EXPORT_CACHE_MAX_MB.
+
+    `keep`: rutas que no se borran (el archivo recién generado y los de trabajos terminados
+    que una sesión todavía puede descargar).
+    """
+    keep = set(keep)
+    d = _cache_dir()
+    entries = []
+    for name in os.listdir(d):
+        path = os.path.join(d, name)
+        try:
+            st_ = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st_.st_mtime, st_.st_size, path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= _cache_max_bytes():
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def cached_export(version_id: int, fmt: str = "xlsx", writer=None, progress=None, filters=None):
+    """Ruta del export `fmt` de la versión, generándolo solo si los datos cambiaron.
+
+    Los filtros forman parte de la clave. Retorna (ruta, hit) donde hit=True si vino de la caché.
+    """
+    writer = writer or FORMATS[fmt][1]
+    filters = _clean_filters(filters)
+    db.ensure_results_wide(version_id)
+    key = _cache_key(db.export_watermark(version_id), fmt, filters)
+    path = os.path.join(_cache_dir(), f"{key}.{fmt}")
+    with _key_lock(key):
+        if os.path.exists(path):
+            os.utime(path)  # marca de uso para el LRU
+            return path, True
+        fd, tmp = tempfile.mkstemp(prefix=f".{key}_", suffix=f".{fmt}", dir=_cache_dir())
+        os.close(fd)
+        try:
+            kwargs = {}
+            if progress:
+                kwargs["progress"] = progress
+            if filters:
+                kwargs["filters"] = filters
+            writer(version_id, tmp, **kwargs)
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        _evict(keep=_live_job_paths() | {path})
+    return path, False
+
+
+# --- Trabajos de exportación en segundo plano ---
+# La exportación corre en un pool de hilos del proceso, no en el hilo del script de Streamlit:
+# si el navegador recarga, la sesión solo vuelve a consultar el estado del trabajo.
+# Registro en memoria del proceso (cada dyno tiene el suyo); el archivo final queda en la caché.
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("EXPORT_WORKERS", "2")), thread_name_prefix="export")
+_jobs = {}
+_jobs_lock = threading.Lock()
+_MAX_JOBS = 50
+
+
+def _update_job(job_id: str, **fields):
+    with _jobs_lock:
+        if job_id in _jobs:
+            _jobs[job_id].update(fields)
+
+
+def _run_job(job_id: str, version_id: int, fmt: str, writer, filters=None):
+    _update_job(job_id, status="running", started=time.time())
+
+    def progress(done: int, total: int):
+        _update_job(job_id, progress=(done / total) if total else 1.0)
+
+    try:
+        path, hit = cached_export(version_id, fmt, writer=writer, progress=progress, filters=filters)
+        # Vista previa calculada una vez aquí: la página la lee del trabajo en cada rerun
+        header, rows = preview(version_id, n=20, filters=filters)
+        _update_job(
+            job_id, status="done", progress=1.0, path=path, hit=hit, preview=(header, rows), finished=time.time(),
+        )
+    except Exception as e:
+        _update_job(job_id, status="error", error=str(e), finished=time.time())
+
+
+def submit_export_job(version_id: int, fmt: str = "xlsx", writer=None, filters=None) -> str:
+    """Encola una exportación y retorna el id del trabajo.
+
+    Si ya hay un trabajo en curso para la misma versión, formato y filtros, retorna ese
+    mismo id (hacer clic otra vez no repite la exportación).
+    """
+    filters = _clean_filters(filters)
+    with _jobs_lock:
+        for job in _jobs.values():
+            if (
+                job["version_id"] == version_id
+                and job["fmt"] == fmt
+                and job["filters"] == filters
+                and job["status"] in ("queued", "running")
+            ):
+                return job["id"]
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {
+            "id": job_id,
+            "version_id": version_id,
+            "fmt": fmt,
+            "filters": filters,
+            "status": "queued",
+            "progress": 0.0,
+            "path": None,
+            "hit": False,
+            "preview": None,
+            "error": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+        }
+        # Mantener acotado el registro: descartar los trabajos terminados más antiguos
+        finished = sorted((j for j in _jobs.values() if j["status"] in ("done", "error")), key=lambda j: j["created"])
+        for old in finished[: max(0, len(_jobs) - _MAX_JOBS)]:
+            _jobs.pop(old["id"], None)
+    _executor.submit(_run_job, job_id, version_id, fmt, writer, filters)
+    return job_id
+
+
+def _live_job_paths() -> set:
+    """Archivos de los trabajos registrados (la página de resultados aún puede abrirlos)."""
+    with _jobs_lock:
+        return {job["path"] for job in _jobs.values() if job["path"]}
+
+
+def get_job(job_id: str | None):
+    """Copia del estado del trabajo (o None si no existe en este proceso)."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
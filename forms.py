@@ -0,0 +1,276 @@
+import os
+import re
+import sys
+import unicodedata
+import time
+import threading
+from types import MappingProxyType
+import db
+import programs
+
+# --- Copia del formulario en memoria del proceso ---
+# El formulario casi nunca cambia, pero se lee en cada rerun de cada sesión. Se guarda una
+# copia por versión junto con su form_revision (ver db.bump_form_revision) y solo se vuelve a
+# cargar cuando la revisión sube:
+#   - cambios hechos en este proceso: db.bump_form_revision actualiza la revisión conocida y la
+#     siguiente lectura recarga de inmediato;
+#   - cambios hechos en otro dyno: se consulta la revisión (1 fila por PK) como máximo cada
+#     FORM_REVISION_POLL_SECONDS segundos.
+#
+# La copia es un modelo inmutable (clases con __slots__, tuplas, MappingProxyType y strings
+# internados) que todas las sesiones comparten por referencia: no se copia ni se serializa
+# por sesión, y nadie puede modificarla por accidente. Trae precalculado lo que la página de
+# la encuesta necesita en cada rerun (enunciado, ayuda, etiquetas de opciones, cascadas).
+
+_SNAPSHOTS = {}  # version_id -> Form
+_CHECKED_AT = {}  # version_id -> time.monotonic() de la última consulta de revisión
+_LOCK = threading.Lock()
+
+
+def _poll_seconds() -> float:
+    return float(os.getenv("FORM_REVISION_POLL_SECONDS", "5"))
+
+
+def _i(s):
+    """Interna strings (etiquetas/codes/nombres se repiten mucho entre preguntas y opciones)."""
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+def _freeze(v):
+    """JSON (config/meta) a estructuras inmutables con strings internados."""
+    if isinstance(v, dict):
+        return MappingProxyType({_i(k): _freeze(x) for k, x in v.items()})
+    if isinstance(v, list):
+        return tuple(_freeze(x) for x in v)
+    return _i(v)
+
+
+def thaw(v):
+    """Inverso de _freeze (para serializar config/meta, p. ej. json.dumps en el admin)."""
+    if isinstance(v, MappingProxyType):
+        return {k: thaw(x) for k, x in v.items()}
+    if isinstance(v, tuple):
+        return [thaw(x) for x in v]
+    return v
+
+
+class _Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} es inmutable")
+
+    def _set(self, **fields):
+        for k, v in fields.items():
+            object.__setattr__(self, k, v)
+
+
+class Option(_Frozen):
+    __slots__ = ("id", "label", "value", "meta")
+
+    def __init__(self, row):
+        self._set(id=int(row["id"]), label=_i(row["label"]), value=_i(row["value"]), meta=_freeze(row.get("meta") or {}))
+
+
+class Question(_Frozen):
+    """Pregunta + campos de render precalculados.
+
+    display_label: enunciado que ve el encuestado (label o, si falta, text).
+    help: ayuda o None. key: clave del widget en session_state.
+    option_labels: etiquetas de las opciones, en orden.
+    options_by_parent / depends_on_label: ver _index_dependencies.
+    """
+
+    __slots__ = (
+        "id", "group_id", "code", "qtype", "label", "text", "help_text", "required", "sort_order",
+        "is_active", "config", "options", "display_label", "help", "key", "option_labels",
+        "options_by_parent", "depends_on_label",
+    )
+
+    def __init__(self, row):
+        label = (row.get("label") or row["text"] or "").strip()
+        help_text = (row.get("help_text") or "").strip() or None
+        options = tuple(Option(o) for o in row.get("options") or ())
+        self._set(
+            id=int(row["id"]),
+            group_id=int(row["group_id"]),
+            code=_i(row.get("code")),
+            qtype=_i(row["qtype"]),
+            label=_i(row.get("label")),
+            text=_i(row["text"]),
+            help_text=_i(row.get("help_text")),
+            required=bool(row.get("required")),
+            sort_order=int(row.get("sort_order") or 0),
+            is_active=bool(row.get("is_active", True)),
+            config=_freeze(row.get("config") or {}),
+            options=options,
+            display_label=_i(label),
+            help=_i(help_text),
+            key=f"q_{int(row['id'])}",
+            option_labels=tuple(o.label for o in options),
+            options_by_parent=MappingProxyType({}),
+            depends_on_label=None,
+        )
+
+
+class Group(_Frozen):
+    __slots__ = ("id", "section_id", "title", "sort_order", "is_active", "questions")
+
+    def __init__(self, row):
+        self._set(
+            id=int(row["id"]),
+            section_id=int(row["section_id"]),
+            title=_i(row["title"]),
+            sort_order=int(row.get("sort_order") or 0),
+            is_active=bool(row.get("is_active", True)),
+            questions=tuple(Question(q) for q in row.get("questions") or ()),
+        )
+
+
+class Section(_Frozen):
+    __slots__ = ("id", "name", "sort_order", "is_active", "groups", "questions")
+
+    def __init__(self, row):
+        groups = tuple(Group(g) for g in row.get("groups") or ())
+        self._set(
+            id=int(row["id"]),
+            name=_i(row["name"]),
+            sort_order=int(row.get("sort_order") or 0),
+            is_active=bool(row.get("is_active", True)),
+            groups=groups,
+            questions=tuple(q for g in groups for q in g.questions),
+        )
+
+
+class Form(_Frozen):
+    """Formulario activo de una versión en una revisión dada.
+
+    sections: secciones en orden. questions: todas las preguntas en orden del formulario.
+    municipality_sections: {municipio normalizado: frozenset(ids de sección)} (programs.py).
+    identity_fields: {id de pregunta: (campos de identificación)} (ver _identity_fields).
+    """
+
+    __slots__ = ("version_id", "revision", "sections", "questions", "municipality_sections", "identity_fields")
+
+    def __init__(self, version_id: int, revision: int, tree, muni_rows):
+        sections = tuple(Section(s) for s in tree)
+        muni = {}
+        for r in muni_rows:
+            muni.setdefault(_i(r["municipality_norm"]), set()).add(int(r["section_id"]))
+        self._set(
+            version_id=version_id,
+            revision=revision,
+            sections=sections,
+            questions=tuple(q for s in sections for q in s.questions),
+            municipality_sections=MappingProxyType({k: frozenset(v) for k, v in muni.items()}),
+            identity_fields=_identity_fields(sections),
+        )
+        _index_dependencies(self.questions)
+
+    def sections_for(self, municipality: str | None):
+        """Secciones a mostrar: PREGUNTAS INICIALES (la primera) + las habilitadas para el
+        municipio. Sin municipio o sin relación conocida: todas."""
+        allowed = self.municipality_sections.get(programs.norm_municipality(municipality)) if municipality else None
+        if not allowed:
+            return self.sections
+        return self.sections[:1] + tuple(s for s in self.sections[1:] if s.id in allowed)
+
+
+def _index_dependencies(questions):
+    """Precalcula las listas en cascada (p. ej. provincia -> municipio -> vereda).
+
+    Cada pregunta con config.depends_on (code de la pregunta padre) recibe:
+      - options_by_parent: {valor del padre: (etiquetas)} según meta[filter_option_meta_key]
+      - depends_on_label: enunciado de la pregunta padre (para los mensajes)
+    Así elegir las opciones es un dict lookup por rerun, sin recorrer todas las opciones.
+    Cada nivel de la cadena se indexa por separado, en un solo recorrido de sus opciones.
+    """
+    label_by_code = {q.code: q.display_label for q in questions if q.code}
+    for q in questions:
+        dep_code = q.config.get("depends_on")
+        if not dep_code:
+            continue
+        meta_key = q.config.get("filter_option_meta_key")
+        index = {}
+        for opt in q.options:
+            parent = opt.meta.get(meta_key)
+            if parent is None or isinstance(parent, (tuple, MappingProxyType)):
+                continue
+            index.setdefault(parent, []).append(opt.label)
+        # Única escritura después de construir (el modelo aún no se publicó)
+        object.__setattr__(q, "options_by_parent", MappingProxyType({k: tuple(v) for k, v in index.items()}))
+        object.__setattr__(q, "depends_on_label", label_by_code.get(dep_code, dep_code))
+
+
+def _norm_text(x: str) -> str:
+    x = (x or "").lower().strip()
+    x = unicodedata.normalize("NFKD", x).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", "", x)
+
+
+# Campos clave de la encuesta (code_<campo> en session_state, se copian a metadata)
+IDENTITY_FIELDS = ("province", "municipality", "full_name", "doc_type", "doc_number", "phone", "email", "role")
+
+
+def _identity_fields(sections):
+    """Campos de identificación (IDENTITY_FIELDS) que aporta cada pregunta.
+
+    Una pregunta con code de identificación aporta ese campo (en cualquier sección). En
+    PREGUNTAS INICIALES, además, se reconocen por título del grupo y enunciado, lo que cubre
+    preguntas duplicadas sin "code". Se resuelve una vez por revisión y la página de la
+    encuesta solo actualiza code_<campo> en el on_change del widget.
+    """
+    out = {}
+    for sec in sections:
+        initial = "preguntas iniciales" in sec.name.lower()
+        for grp in sec.groups:
+            gname_n = _norm_text(grp.title) if initial else ""
+            for q in grp.questions:
+                fields = [q.code] if q.code in IDENTITY_FIELDS else []
+                if not initial:
+                    if fields:
+                        out[q.id] = tuple(_i(f) for f in fields)
+                    continue
+                qtext_n = _norm_text(q.display_label)
+                if "ubic" in gname_n:
+                    if "provinc" in qtext_n:
+                        fields.append("province")
+                    if "municip" in qtext_n:
+                        fields.append("municipality")
+                if "ident" in gname_n:
+                    if "nombre" in qtext_n:
+                        fields.append("full_name")
+                    if "tipodedocument" in qtext_n or ("tipo" in qtext_n and "document" in qtext_n):
+                        fields.append("doc_type")
+                    if "numerodedocument" in qtext_n or ("numero" in qtext_n and "document" in qtext_n):
+                        fields.append("doc_number")
+                    if "celular" in qtext_n or "telefono" in qtext_n:
+                        fields.append("phone")
+                    if "correo" in qtext_n or "email" in qtext_n:
+                        fields.append("email")
+                    if "cargo" in qtext_n or "rol" in qtext_n:
+                        fields.append("role")
+                if fields:
+                    out[q.id] = tuple(_i(f) for f in dict.fromkeys(fields))
+    return MappingProxyType(out)
+
+
+def snapshot(version_id: int) -> Form:
+    """Formulario de la versión (ver Form), compartido por todas las sesiones del proceso."""
+    snap = _SNAPSHOTS.get(version_id)
+    fresh_local = snap is not None and snap.revision >= db.known_form_revision(version_id)
+    if fresh_local and time.monotonic() - _CHECKED_AT.get(version_id, 0.0) < _poll_seconds():
+        return snap
+
+    rev = db.form_revision(version_id)
+    _CHECKED_AT[version_id] = time.monotonic()
+    if snap is not None and snap.revision == rev:
+        return snap
+    with _LOCK:
+        # Otra sesión pudo haberlo cargado mientras esperábamos el lock
+        snap = _SNAPSHOTS.get(version_id)
+        if snap is not None and snap.revision == rev:
+            return snap
+        snap = Form(version_id, rev, db.get_form(version_id), db.municipality_sections(version_id))
+        _SNAPSHOTS[version_id] = snap
+        return snap
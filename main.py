@@ -3,13 +3,14 @@ from pathlib import Path
 import streamlit as st
 from dotenv import load_dotenv
 
-import db
 import auth
+import migrations
 from routes.survey import survey_page
 from routes.questions_admin import questions_admin_page
 from routes.results import results_page
 from routes.users import users_page
 from routes.help_deploy import help_deploy_page
+from routes.perf import perf_page
 
 load_dotenv()
 
@@ -32,37 +33,9 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-# --- DB init + seed ---
-db.init_database()
-auth.ensure_default_admin()
+# --- DB init + seed (migraciones: una vez por proceso, ver migrations.py) ---
 seed_path = str(Path(__file__).parent / "data" / "seed_questions.json")
-version_id = db.ensure_seed(seed_path)
-
-# Asegura campos de identificación (para BD ya sembradas)
-db.ensure_initial_identity_questions(version_id)
-
-# Asegura que Provincia/Municipio y campos iniciales tengan codes (para exportar siempre)
-db.ensure_core_question_codes(version_id)
-
-# Regla PIC: todos estos bloques (todo menos "PREGUNTAS INICIALES") NO deben ser obligatorios.
-db.set_required_for_sections(
-    version_id,
-    [
-        "ENFERMEDADES NO TRANSMISIBLES",
-        "SEGURIDAD ALIMENTARIA",
-        "ENFERMEDADES TRANSMISIBLES",
-        "ENFERMEDADES TRANSMITIDAS POR VECTORES – ETV",
-        "SALUD MENTAL Y SUSTANCIAS PSICOACTIVAS",
-        "SALUD INFANTIL",
-        "SALUD SEXUAL Y REPRODUCTIVA",
-        "SALUD LABORAL",
-        "SALUD AMBIENTAL Y ZOONOSIS",
-    ],
-    required=False,
-)
-
-# Actualiza el encabezado estándar A..F en todos los grupos de secciones PIC (si aplica)
-db.standardize_pic_group_questions(version_id)
+version_id = migrations.bootstrap(seed_path)
 
 # --- Session init ---
 if "user" not in st.session_state:
@@ -83,6 +56,7 @@ if st.session_state.user:
         "Admin: Gestión de preguntas",
         "Admin: Respuestas / Exportar",
         "Admin: Usuarios",
+        "Admin: Rendimiento",
         "Admin: Ayuda (Deploy)",
     ]
 
@@ -106,5 +80,10 @@ elif page == "Admin: Usuarios":
         st.error("Solo admin puede gestionar usuarios.")
     else:
         users_page()
+elif page == "Admin: Rendimiento":
+    if not auth.require_role(["admin"]):
+        st.error("Solo admin puede ver el rendimiento.")
+    else:
+        perf_page()
 elif page == "Admin: Ayuda (Deploy)":
     help_deploy_page()
\ No newline at end of file
@@ -0,0 +1,98 @@
+import threading
+import db
+import auth
+import programs
+
+# Secciones PIC (todo menos "PREGUNTAS INICIALES"): sus preguntas NO son obligatorias.
+PIC_SECTIONS = [
+    "ENFERMEDADES NO TRANSMISIBLES",
+    "SEGURIDAD ALIMENTARIA",
+    "ENFERMEDADES TRANSMISIBLES",
+    "ENFERMEDADES TRANSMITIDAS POR VECTORES – ETV",
+    "SALUD MENTAL Y SUSTANCIAS PSICOACTIVAS",
+    "SALUD INFANTIL",
+    "SALUD SEXUAL Y REPRODUCTIVA",
+    "SALUD LABORAL",
+    "SALUD AMBIENTAL Y ZOONOSIS",
+]
+
+# Migraciones numeradas e idempotentes. Cada una se aplica una sola vez y queda registrada
+# en schema_migrations. Alcance:
+#   "global"  -> una vez por BD (esquema)
+#   "version" -> una vez por cada versión de encuesta (recibe version_id)
+# Para agregar un cambio nuevo: agregar una tupla al final con el siguiente número.
+# Nunca renumerar ni borrar pasos ya desplegados.
+MIGRATIONS = [
+    (1, "global", "init_database", lambda _vid: db.init_database()),
+    # Asegura campos de identificación (para BD ya sembradas)
+    (2, "version", "initial_identity_questions", db.ensure_initial_identity_questions),
+    # Asegura que Provincia/Municipio y campos iniciales tengan codes (para exportar siempre)
+    (3, "version", "core_question_codes", db.ensure_core_question_codes),
+    # Regla PIC: todos estos bloques NO deben ser obligatorios.
+    (4, "version", "pic_sections_not_required",
+     lambda vid: db.set_required_for_sections(vid, PIC_SECTIONS, required=False)),
+    # Actualiza el encabezado estándar A..F en todos los grupos de secciones PIC (si aplica)
+    (5, "version", "standardize_pic_group_questions", db.standardize_pic_group_questions),
+    # Respuestas como JSONB por encuesta (ANSWERS_STORAGE=jsonb) + vista survey_answers_all
+    (6, "global", "answers_jsonb", lambda _vid: db.add_answers_jsonb()),
+    # Tabla materializada de resultados en formato ancho (se llena en la primera exportación)
+    (7, "global", "results_wide", lambda _vid: db.add_results_wide()),
+    # Columnas generadas province/municipality/doc_type/doc_number + índices
+    (8, "global", "identity_columns", lambda _vid: db.add_identity_columns()),
+    # Índices para la paginación por llave del navegador de encuestas
+    (9, "global", "response_browse_indexes", lambda _vid: db.add_response_browse_indexes()),
+    # Archivo comprimido para las encuestas de versiones cerradas
+    (10, "global", "responses_archive", lambda _vid: db.add_responses_archive()),
+    # Contador de revisión del formulario (invalida la copia en memoria de forms.py)
+    (11, "global", "form_revision", lambda _vid: db.add_form_revision()),
+    # Índices para armar el formulario en una sola consulta (get_form)
+    (12, "global", "form_tree_indexes", lambda _vid: db.add_form_tree_indexes()),
+    # Programas contratados por municipio: tabla + carga inicial desde data/municipio_programas.json
+    (13, "global", "municipality_sections", lambda _vid: db.add_municipality_sections()),
+    (14, "version", "import_municipality_sections", programs.import_default),
+    # Rellena metadata.province/municipality/... en encuestas antiguas: las columnas generadas
+    # (paso 8) y los filtros quedan igual que Provincia/Municipio de la exportación
+    (15, "version", "repair_response_metadata_keys", db.repair_response_metadata_keys),
+]
+
+_LOCK_KEY = 72_540_001  # clave fija para pg_advisory_lock del bootstrap
+_lock = threading.Lock()
+_done = {}
+
+def _apply(scope: str, scope_id: int, applied: set):
+    changed = False
+    for step, step_scope, name, fn in MIGRATIONS:
+        if step_scope != scope or (step, scope_id) in applied:
+            continue
+        fn(scope_id or None)
+        db.record_migration(step, scope_id, name)
+        applied.add((step, scope_id))
+        changed = True
+    if changed and scope == "version":
+        # Los repairs pueden mover codes/textos: una nueva revisión del formulario (una por
+        # bootstrap, no por paso) y la tabla ancha debe recalcularse
+        db.bump_form_revision(scope_id)
+        db.mark_results_wide_stale(scope_id)
+
+def _run(seed_path: str) -> int:
+    with db.advisory_lock(_LOCK_KEY):
+        db.ensure_migrations_table()
+        applied = db.applied_migrations()
+        _apply("global", 0, applied)
+        auth.ensure_default_admin()
+        version_id = db.ensure_seed(seed_path)
+        _apply("version", int(version_id), applied)
+        return version_id
+
+def bootstrap(seed_path: str) -> int:
+    """Prepara la BD y retorna el id de la versión activa.
+
+    Streamlit re-ejecuta main.py en cada interacción: el resultado se guarda a nivel de
+    proceso, así que las migraciones corren una vez por deploy/dyno y luego se omiten.
+    """
+    if seed_path in _done:
+        return _done[seed_path]
+    with _lock:
+        if seed_path not in _done:
+            _done[seed_path] = _run(seed_path)
+    return _done[seed_path]
@@ -0,0 +1,131 @@
+import re
+import json
+import unicodedata
+from pathlib import Path
+import db
+
+# --- Programas PIC contratados por municipio ---
+# Cada municipio solo diligencia las secciones de los programas que tiene contratados.
+# La relación vive en la tabla municipality_sections (nombre normalizado + id de sección) y
+# se carga desde el listado oficial (data/LISTADO_MUNICIPIOS_PROGRAMAS.xlsx) o desde el JSON
+# ya convertido (data/municipio_programas.json). Importar sube la revisión del formulario,
+# así forms.py recarga la relación en todos los procesos sin redeploy.
+
+DATA_DIR = Path(__file__).resolve().parent / "data"
+DEFAULT_JSON = DATA_DIR / "municipio_programas.json"
+
+# Texto del listado (normalizado) -> sección de la encuesta. El listado es texto libre y
+# trae variantes ("VIDA SALUDABLE", "CRÓNICAS NO TRANSMISIBLES", "TB Y HANSEN", "SALU INFANTIL"...).
+# Programas sin sección en la encuesta (Promoción social, Economía popular, Cáncer...) se ignoran.
+PROGRAM_KEYWORDS = [
+    (r"NO TRANSMISIBLES|VIDA SALUDABLE|CRONICAS", "ENFERMEDADES NO TRANSMISIBLES"),
+    (r"\bTB\b|TUBERCULOSIS|HANSEN|VIH", "ENFERMEDADES TRANSMISIBLES"),
+    (r"\bETV\b|VECTORES", "ENFERMEDADES TRANSMITIDAS POR VECTORES – ETV"),
+    (r"SALUD MENTAL|PSICOACTIVAS", "SALUD MENTAL Y SUSTANCIAS PSICOACTIVAS"),
+    (r"INFANTIL|\bPAI\b", "SALUD INFANTIL"),
+    (r"SEXUAL|SEXULES|REPRODUCTIV", "SALUD SEXUAL Y REPRODUCTIVA"),
+    (r"ALIMENTARIA", "SEGURIDAD ALIMENTARIA"),
+    (r"LABORAL", "SALUD LABORAL"),
+    (r"AMBIENTAL|ZOONOSIS", "SALUD AMBIENTAL Y ZOONOSIS"),
+]
+
+
+def norm_municipality(s: str | None) -> str:
+    """Nombre comparable: mayúsculas, sin tildes, espacios colapsados."""
+    if not s:
+        return ""
+    s = str(s).strip().upper()
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", s)
+
+
+def sections_for_program_text(text: str) -> list[str]:
+    """Secciones de la encuesta que corresponden a la celda de programas del listado."""
+    t = norm_municipality(text)
+    return [section for pattern, section in PROGRAM_KEYWORDS if re.search(pattern, t)]
+
+
+def parse_xlsx(path) -> dict[str, list[str]]:
+    """{municipio: [secciones]} desde el listado oficial.
+
+    Busca la fila de encabezado con "MUNICIPIO" y "PROGRAMA" (la hoja trae columnas vacías
+    y numeración antes de los datos).
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        col_muni = col_prog = None
+        out = {}
+        for row in ws.iter_rows(values_only=True):
+            cells = [norm_municipality(c) if isinstance(c, str) else c for c in row]
+            if col_muni is None:
+                for i, c in enumerate(cells):
+                    if isinstance(c, str) and c == "MUNICIPIO":
+                        col_muni = i
+                    elif isinstance(c, str) and c.startswith("PROGRAMA"):
+                        col_prog = i
+                if col_muni is None or col_prog is None:
+                    col_muni = col_prog = None
+                continue
+            muni = str(row[col_muni] or "").strip() if col_muni < len(row) else ""
+            if not muni:
+                continue
+            prog = row[col_prog] if col_prog < len(row) else None
+            sections = out.setdefault(muni, [])
+            for section in sections_for_program_text(prog or ""):
+                if section not in sections:
+                    sections.append(section)
+    finally:
+        wb.close()
+    if col_muni is None:
+        raise ValueError("No se encontró el encabezado MUNICIPIO / PROGRAMA en el archivo.")
+    return out
+
+
+def parse_json(path) -> dict[str, list[str]]:
+    """{municipio: [secciones]} desde municipio_programas.json."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return dict(data.get("municipality_to_sections", data))
+
+
+def import_mapping(version_id: int, mapping: dict[str, list[str]]) -> dict:
+    """Reemplaza la relación municipio -> secciones de la versión.
+
+    Retorna {"municipalities": n, "rows": n, "unknown_sections": [...]} (secciones del
+    archivo que no existen en la versión; esas se omiten).
+    """
+    section_ids = {norm_municipality(s["name"]): s["id"] for s in db.list_sections(version_id)}
+    rows, unknown = [], set()
+    for muni, sections in mapping.items():
+        key = norm_municipality(muni)
+        if not key:
+            continue
+        for name in sections:
+            sid = section_ids.get(norm_municipality(name))
+            if sid is None:
+                unknown.add(name)
+            else:
+                rows.append((key, str(muni).strip(), sid))
+    db.replace_municipality_sections(version_id, rows)
+    return {
+        "municipalities": len({r[0] for r in rows}),
+        "rows": len(rows),
+        "unknown_sections": sorted(unknown),
+    }
+
+
+def import_file(version_id: int, path) -> dict:
+    """Importa el .xlsx del listado o el .json convertido (según la extensión)."""
+    path = Path(path)
+    mapping = parse_xlsx(path) if path.suffix.lower() in (".xlsx", ".xlsm") else parse_json(path)
+    return import_mapping(version_id, mapping)
+
+
+def import_default(version_id: int):
+    """Migración: carga el JSON incluido en el repo (si la versión aún no tiene relación)."""
+    if DEFAULT_JSON.exists() and not db.municipality_sections(version_id):
+        import_file(version_id, DEFAULT_JSON)
@@ -0,0 +1,33 @@
+import os
+import streamlit as st
+import pandas as pd
+import db
+
+
+def perf_page():
+    st.title("Rendimiento (consultas a la BD)")
+    st.caption(
+        "Tiempos registrados en este proceso (dyno) desde que arrancó o desde el último reinicio de "
+        f"estadísticas. Las consultas de más de {db.slow_query_ms():.0f} ms también quedan en el log "
+        "(`heroku logs --tail`). Umbral configurable con DB_SLOW_QUERY_MS."
+    )
+
+    stats = db.query_stats(limit=int(os.getenv("DB_QUERY_STATS_TOP", "50")))
+    if not stats:
+        st.info("Aún no hay consultas registradas.")
+    else:
+        df = pd.DataFrame(stats)[["kind", "calls", "total_ms", "mean_ms", "max_ms", "rows", "name"]]
+        df = df.rename(columns={
+            "kind": "Tipo",
+            "calls": "Llamadas",
+            "total_ms": "Total (ms)",
+            "mean_ms": "Promedio (ms)",
+            "max_ms": "Máx (ms)",
+            "rows": "Filas",
+            "name": "Consulta / función",
+        })
+        st.dataframe(df.round(1), use_container_width=True, hide_index=True)
+
+    if st.button("Reiniciar estadísticas"):
+        db.reset_query_stats()
+        st.rerun()
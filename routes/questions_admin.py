@@ -2,6 +2,8 @@
 import json
 import streamlit as st
 import db
+import forms
+import programs
 
 Q_TYPES = [
     ("yes_no", "Sí/No"),
@@ -29,23 +31,65 @@ def _safe_json(text):
     except Exception as e:
         raise ValueError(str(e))
 
+def _programs_tab(version_id: int):
+    """Secciones habilitadas por municipio: ver la relación actual e importar el listado."""
+    st.subheader("Programas contratados por municipio")
+    st.caption(
+        "Cada municipio solo ve las secciones de sus programas (además de PREGUNTAS INICIALES). "
+        "Los municipios sin relación ven todas las secciones. Los cambios aplican de inmediato, sin redeploy."
+    )
+    rows = db.municipality_sections(version_id)
+    if rows:
+        by_muni = {}
+        for r in rows:
+            by_muni.setdefault(r["municipality"], []).append(r["section_name"])
+        st.dataframe(
+            [{"Municipio": m, "Secciones": ", ".join(secs)} for m, secs in by_muni.items()],
+            use_container_width=True,
+            hide_index=True,
+        )
+    else:
+        st.info("Aún no hay relación cargada: todos los municipios ven todas las secciones.")
+
+    up = st.file_uploader(
+        "Listado de municipios y programas (.xlsx oficial o .json convertido)",
+        type=["xlsx", "json"],
+        key="programs_upload",
+    )
+    if up is not None and st.button("Importar y reemplazar", type="primary", key="programs_import"):
+        import tempfile
+        from pathlib import Path
+
+        suffix = Path(up.name).suffix.lower()
+        with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+            tmp.write(up.getvalue())
+            tmp.flush()
+            try:
+                res = programs.import_file(version_id, tmp.name)
+            except Exception as e:
+                st.error(f"No se pudo importar: {e}")
+                return
+        st.success(f"Importados {res['municipalities']} municipios ({res['rows']} relaciones).")
+        if res["unknown_sections"]:
+            st.warning("Secciones del archivo que no existen en la encuesta (omitidas): " + ", ".join(res["unknown_sections"]))
+
 def questions_admin_page(version_id: int):
     st.title("Gestión de preguntas (CRUD)")
 
-    form = db.get_form(version_id)
-    sections = [(s["id"], s["name"]) for s in form]
+    form = forms.snapshot(version_id)
+    sections = [(s.id, s.name) for s in form.sections]
 
-    tab1, tab2, tab3 = st.tabs(["Secciones", "Grupos", "Preguntas"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Secciones", "Grupos", "Preguntas", "Programas por municipio"])
 
     with tab1:
         st.subheader("Secciones")
-        for s in form:
-            with st.expander(f"Editar: {s['name']}", expanded=False):
-                name = st.text_input("Nombre", value=s["name"], key=f"sec_name_{s['id']}")
-                order = st.number_input("Orden", min_value=1, value=int(s["sort_order"]), key=f"sec_ord_{s['id']}")
-                active = st.checkbox("Activa", value=bool(s["is_active"]), key=f"sec_act_{s['id']}")
-                if st.button("Guardar sección", key=f"sec_save_{s['id']}"):
-                    db.upsert_section(version_id, s["id"], name, int(order), bool(active))
+        for s in form.sections:
+            with st.expander(f"Editar: {s.name}", expanded=False):
+                name = st.text_input("Nombre", value=s.name, key=f"sec_name_{s.id}")
+                order = st.number_input("Orden", min_value=1, value=int(s.sort_order), key=f"sec_ord_{s.id}")
+                active = st.checkbox("Activa", value=s.is_active, key=f"sec_act_{s.id}")
+                if st.button("Guardar sección", key=f"sec_save_{s.id}"):
+                    db.upsert_section(version_id, s.id, name, int(order), bool(active))
                     st.success("Guardado.")
                     st.rerun()
 
@@ -68,17 +112,14 @@ def questions_admin_page(version_id: int):
         else:
             sec_id = st.selectbox("Sección", options=[s[0] for s in sections], format_func=lambda i: dict(sections)[i])
             # listar grupos de esa sección
-            groups = []
-            for s in form:
-                if s["id"] == sec_id:
-                    groups = s.get("groups", [])
+            groups = next((s.groups for s in form.sections if s.id == sec_id), ())
             for g in groups:
-                with st.expander(f"Editar grupo: {g['title']}", expanded=False):
-                    title = st.text_area("Título", value=g["title"], key=f"grp_title_{g['id']}")
-                    order = st.number_input("Orden", min_value=1, value=int(g["sort_order"]), key=f"grp_ord_{g['id']}")
-                    active = st.checkbox("Activo", value=bool(g["is_active"]), key=f"grp_act_{g['id']}")
-                    if st.button("Guardar grupo", key=f"grp_save_{g['id']}"):
-                        db.upsert_group(version_id, g["id"], sec_id, title.strip(), int(order), bool(active))
+                with st.expander(f"Editar grupo: {g.title}", expanded=False):
+                    title = st.text_area("Título", value=g.title, key=f"grp_title_{g.id}")
+                    order = st.number_input("Orden", min_value=1, value=int(g.sort_order), key=f"grp_ord_{g.id}")
+                    active = st.checkbox("Activo", value=g.is_active, key=f"grp_act_{g.id}")
+                    if st.button("Guardar grupo", key=f"grp_save_{g.id}"):
+                        db.upsert_group(version_id, g.id, sec_id, title.strip(), int(order), bool(active))
                         st.success("Guardado.")
                         st.rerun()
 
@@ -94,6 +135,10 @@ def questions_admin_page(version_id: int):
                     st.success("Grupo creado.")
                     st.rerun()
 
+    # (antes de la pestaña de preguntas, que puede terminar la función con return)
+    with tab4:
+        _programs_tab(version_id)
+
     with tab3:
         st.subheader("Preguntas")
         # seleccionar sección y grupo
@@ -101,64 +146,57 @@ def questions_admin_page(version_id: int):
             st.warning("Crea una sección primero.")
             return
         sec_id = st.selectbox("Sección", options=[s[0] for s in sections], format_func=lambda i: dict(sections)[i], key="q_sec")
-        groups = []
-        for s in form:
-            if s["id"] == sec_id:
-                groups = s.get("groups", [])
+        groups = next((s.groups for s in form.sections if s.id == sec_id), ())
         if not groups:
             st.warning("Crea un grupo primero.")
             return
-        group_map = {g["id"]: g["title"] for g in groups}
+        group_map = {g.id: g.title for g in groups}
         grp_id = st.selectbox("Grupo", options=list(group_map.keys()), format_func=lambda i: group_map[i], key="q_grp")
 
         # obtener preguntas del grupo
-        qs = []
-        for g in groups:
-            if g["id"] == grp_id:
-                qs = g.get("questions", [])
+        qs = next((g.questions for g in groups if g.id == grp_id), ())
 
         for q in qs:
-            display = (q.get('label') or q['text'] or "")
-            with st.expander(f"Editar pregunta: {display[:80]}", expanded=False):
+            with st.expander(f"Editar pregunta: {(q.label or q.text or '')[:80]}", expanded=False):
                 label = st.text_area(
                     "Nombre / Enunciado (lo que ve el encuestado)",
-                    value=(q.get("label") or q["text"]),
-                    key=f"q_label_{q['id']}",
+                    value=(q.label or q.text),
+                    key=f"q_label_{q.id}",
                     height=80,
                 )
                 help_text = st.text_input(
                     "Ayuda (opcional, debajo del enunciado)",
-                    value=q.get("help_text") or "",
-                    key=f"q_help_{q['id']}",
+                    value=q.help_text or "",
+                    key=f"q_help_{q.id}",
                 )
                 text = st.text_area(
                     "Descripción interna / respaldo (opcional)",
-                    value=q["text"],
-                    key=f"q_text_{q['id']}",
+                    value=q.text,
+                    key=f"q_text_{q.id}",
                     height=120,
                 )
-                code = st.text_input("Code (opcional, único por versión)", value=q.get("code") or "", key=f"q_code_{q['id']}")
-                qtype = st.selectbox("Tipo", options=[t[0] for t in Q_TYPES], format_func=lambda v: dict(Q_TYPES)[v], index=[t[0] for t in Q_TYPES].index(q["qtype"]), key=f"q_type_{q['id']}")
-                required = st.checkbox("Obligatoria", value=bool(q["required"]), key=f"q_req_{q['id']}")
-                order = st.number_input("Orden", min_value=1, value=int(q["sort_order"]), key=f"q_ord_{q['id']}")
-                active = st.checkbox("Activa", value=bool(q["is_active"]), key=f"q_act_{q['id']}")
+                code = st.text_input("Code (opcional, único por versión)", value=q.code or "", key=f"q_code_{q.id}")
+                qtype = st.selectbox("Tipo", options=[t[0] for t in Q_TYPES], format_func=lambda v: dict(Q_TYPES)[v], index=[t[0] for t in Q_TYPES].index(q.qtype), key=f"q_type_{q.id}")
+                required = st.checkbox("Obligatoria", value=q.required, key=f"q_req_{q.id}")
+                order = st.number_input("Orden", min_value=1, value=int(q.sort_order), key=f"q_ord_{q.id}")
+                active = st.checkbox("Activa", value=q.is_active, key=f"q_act_{q.id}")
 
                 c1, c2 = st.columns([1, 3])
                 with c1:
-                    if st.button("Quitar _____", key=f"q_clean_{q['id']}"):
-                        st.session_state[f"q_label_{q['id']}"] = _sanitize_title(st.session_state.get(f"q_label_{q['id']}", ""))
-                        st.session_state[f"q_text_{q['id']}"] = _sanitize_title(st.session_state.get(f"q_text_{q['id']}", ""))
+                    if st.button("Quitar _____", key=f"q_clean_{q.id}"):
+                        st.session_state[f"q_label_{q.id}"] = _sanitize_title(st.session_state.get(f"q_label_{q.id}", ""))
+                        st.session_state[f"q_text_{q.id}"] = _sanitize_title(st.session_state.get(f"q_text_{q.id}", ""))
                         st.rerun()
                 with c2:
                     st.caption("Tip: el nombre/enunciado es lo que aparece arriba en la encuesta. Puedes editarlo aquí.")
 
-                config_txt = st.text_area("Config (JSON) - opcional", value=json.dumps(q.get("config") or {}, ensure_ascii=False, indent=2), height=120, key=f"q_cfg_{q['id']}")
-                if st.button("Guardar pregunta", key=f"q_save_{q['id']}"):
+                config_txt = st.text_area("Config (JSON) - opcional", value=json.dumps(forms.thaw(q.config), ensure_ascii=False, indent=2), height=120, key=f"q_cfg_{q.id}")
+                if st.button("Guardar pregunta", key=f"q_save_{q.id}"):
                     try:
                         config = _safe_json(config_txt)
                         db.upsert_question(
                             version_id,
-                            q["id"],
+                            q.id,
                             grp_id,
                             code.strip() or None,
                             (label.strip() or text.strip()),
@@ -179,12 +217,11 @@ def questions_admin_page(version_id: int):
                 if qtype in ("single_choice","multi_choice"):
                     st.markdown("**Opciones** (se reemplazan al guardar)")
                     # mostrar actuales
-                    cur_opts = q.get("options", [])
-                    opts_txt = "\n".join([o["label"] for o in cur_opts]) if cur_opts else ""
-                    new_opts = st.text_area("Una opción por línea", value=opts_txt, height=150, key=f"q_opts_{q['id']}")
+                    opts_txt = "\n".join(q.option_labels)
+                    new_opts = st.text_area("Una opción por línea", value=opts_txt, height=150, key=f"q_opts_{q.id}")
                     meta_note = st.info("Si necesitas meta (ej. municipios por provincia), edita el JSON en la BD o en el seed. Para el caso municipio, ya viene configurado.")
                     # Botón especial: sincronizar municipio/provincia desde seed (para meta province)
-                    if (q.get("code") == "municipality") and st.button("Sincronizar municipios por provincia (desde seed)", key=f"sync_muni_{q['id']}"):
+                    if (q.code == "municipality") and st.button("Sincronizar municipios por provincia (desde seed)", key=f"sync_muni_{q.id}"):
                         try:
                             from pathlib import Path
                             import json as _json
@@ -203,26 +240,25 @@ def questions_admin_page(version_id: int):
                             if mun_opts is None:
                                 st.error("No se encontró 'municipality' en el seed.")
                             else:
-                                db.delete_options_for_question(q["id"])
-                                for idx, opt in enumerate(mun_opts, start=1):
-                                    db.insert_option(q["id"], opt["label"], opt.get("value", opt["label"]), idx, opt.get("meta", {}))
+                                def _seed_opts(opts):
+                                    return [(opt["label"], opt.get("value", opt["label"]), opt.get("meta", {})) for opt in opts]
+
+                                changes = {q.id: _seed_opts(mun_opts)}
                                 # opcional: también sincroniza provincias si están en el mismo grupo
                                 if prov_opts is not None:
                                     prov_row = db.fetchone("SELECT id FROM questions WHERE version_id=%s AND code='province' LIMIT 1;", (version_id,))
                                     if prov_row:
-                                        db.delete_options_for_question(prov_row["id"])
-                                        for idx, opt in enumerate(prov_opts, start=1):
-                                            db.insert_option(prov_row["id"], opt["label"], opt.get("value", opt["label"]), idx, opt.get("meta", {}))
+                                        changes[int(prov_row["id"])] = _seed_opts(prov_opts)
+                                # Una transacción y una sola revisión del formulario
+                                db.replace_options(version_id, changes)
                                 st.success("Municipios (y provincias) sincronizados.")
                                 st.rerun()
                         except Exception as e:
                             st.error(f"Error sincronizando: {e}")
 
-                    if st.button("Guardar opciones", key=f"q_opts_save_{q['id']}"):
-                        db.delete_options_for_question(q["id"])
+                    if st.button("Guardar opciones", key=f"q_opts_save_{q.id}"):
                         lines = [l.strip() for l in new_opts.splitlines() if l.strip()]
-                        for idx, label in enumerate(lines, start=1):
-                            db.insert_option(q["id"], label, label, idx, {})
+                        db.replace_options(version_id, {q.id: [(label, label, {}) for label in lines]})
                         st.success("Opciones guardadas.")
                         st.rerun()
 
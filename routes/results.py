@@ -1,63 +1,234 @@
-import io
-import datetime
+import hashlib
 import streamlit as st
 import pandas as pd
 import db
+import exports
 
 
 
-def _excel_safe(df: pd.DataFrame) -> pd.DataFrame:
-    """Convierte columnas datetime con timezone a naive (Excel no soporta tz-aware)."""
-    df = df.copy()
-    for col in df.columns:
-        s = df[col]
-        try:
-            if pd.api.types.is_datetime64tz_dtype(s):
-                df[col] = s.dt.tz_convert(None)
-        except Exception:
-            pass
-        # object dtype con datetimes tz-aware
-        if df[col].dtype == "object":
-            def _fix(v):
-                if isinstance(v, (datetime.datetime,)):
-                    if v.tzinfo is not None:
-                        return v.replace(tzinfo=None)
-                return v
-            df[col] = df[col].map(_fix)
-    return df
+@st.fragment(run_every=2)
+def _export_progress(job_id: str):
+    """Muestra el avance del trabajo de exportación; al terminar recarga la página."""
+    job = exports.get_job(job_id)
+    if not job or job["status"] not in ("queued", "running"):
+        st.rerun()
+    label = "En cola..." if job["status"] == "queued" else f"Generando archivo... {job['progress']:.0%}"
+    st.progress(job["progress"], text=label)
+
+_BROWSE_PAGE_SIZE = 50
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _counts_by_municipality(version_id: int):
+    """Conteo por provincia/municipio (agrupa toda la versión: se reutiliza hasta 60 s)."""
+    return [dict(r) for r in db.count_responses_by_municipality(version_id)]
+
+def _response_browser(version_id: int):
+    """Páginas de 50 encuestas (paginación por llave), filtros indexados y detalle bajo demanda."""
+    locations = db.response_locations(version_id)
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        provs = list(dict.fromkeys(r["province"] for r in locations if r["province"]))
+        prov = st.selectbox("Provincia", provs, index=None, placeholder="Todas", key="br_province")
+    with c2:
+        munis = sorted({r["municipality"] for r in locations if r["municipality"] and (not prov or r["province"] == prov)})
+        muni = st.selectbox("Municipio", munis, index=None, placeholder="Todos", key="br_municipality")
+    with c3:
+        doc = st.text_input("Número de documento", key="br_doc_number").strip()
+    filters = {"province": prov, "municipality": muni, "doc_number": doc}
+
+    # Pila de cursores: after_id de cada página visitada (se reinicia si cambian los filtros)
+    if st.session_state.get("_browse_filters") != filters:
+        st.session_state["_browse_filters"] = filters
+        st.session_state["_browse_pages"] = [None]
+    pages = st.session_state["_browse_pages"]
+    rows, has_more = db.browse_responses(version_id, filters, after_id=pages[-1], limit=_BROWSE_PAGE_SIZE)
+
+    if not rows:
+        st.info("No hay encuestas con esos filtros.")
+    else:
+        df = pd.DataFrame(rows).rename(columns={
+            "id": "ID", "created_at": "Fecha", "province": "Provincia", "municipality": "Municipio",
+            "doc_type": "Tipo doc.", "doc_number": "Documento", "full_name": "Nombre", "encuestador": "Encuestador(a)",
+        })
+        # La selección del widget son posiciones: la clave depende de los ids mostrados, así
+        # que si cambian (filtros, otra página, encuestas nuevas) la selección se descarta.
+        shown = tuple(int(r["id"]) for r in rows)
+        table_key = "br_table_" + hashlib.sha1(repr(shown).encode()).hexdigest()[:12]
+        event = st.dataframe(
+            df, use_container_width=True, hide_index=True,
+            on_select="rerun", selection_mode="multi-row", key=table_key,
+        )
+        selected = [shown[i] for i in event.selection.rows if i < len(shown)]
+
+    p1, p2, p3 = st.columns([1, 1, 3])
+    with p1:
+        if st.button("← Más recientes", disabled=len(pages) == 1):
+            pages.pop()
+            st.rerun()
+    with p2:
+        if st.button("Más antiguas →", disabled=not has_more):
+            pages.append(int(rows[-1]["id"]))
+            st.rerun()
+    with p3:
+        st.caption(f"Página {len(pages)}")
+
+    if not rows:
+        return
+
+    if len(selected) == 1:
+        detail = db.get_response_detail(version_id, selected[0])
+        if detail:
+            st.markdown(f"**Encuesta #{detail['id']}** · {str(detail['created_at'])[:19]}")
+            meta = detail["metadata"] or {}
+            doc_number = str(meta.get("doc_number") or "").strip()
+            if doc_number:
+                # Posibles duplicados: otras encuestas con el mismo documento (índice por documento)
+                dups = [
+                    d for d in db.find_responses_by_document(version_id, meta.get("doc_type"), doc_number)
+                    if int(d["id"]) != int(detail["id"])
+                ]
+                if dups:
+                    st.warning(
+                        "Hay otras encuestas con este documento: "
+                        + ", ".join(f"#{d['id']}" for d in dups[:10])
+                        + ("..." if len(dups) > 10 else "")
+                    )
+            answers = [
+                {
+                    "Sección": a["section"],
+                    "Grupo": a["group"],
+                    "Pregunta": a["question"],
+                    "Respuesta": ", ".join(map(str, a["value"])) if isinstance(a["value"], list) else str(a["value"]),
+                }
+                for a in detail["answers"]
+            ]
+            if answers:
+                st.dataframe(pd.DataFrame(answers), use_container_width=True, hide_index=True)
+            else:
+                st.info("Esta encuesta no tiene respuestas guardadas.")
+            with st.popover("Metadata"):
+                st.json(detail["metadata"] or {})
+    elif not selected:
+        st.caption("Selecciona una fila para ver sus respuestas; varias para borrarlas.")
+
+    st.warning("⚠️ Borrar elimina encuestas y sus respuestas. No se puede deshacer.")
+    ids_text = ", ".join(f"#{i}" for i in selected)
+    # La clave incluye los ids: si la selección cambia, hay que volver a confirmar
+    confirm = st.checkbox(
+        f"Confirmo que quiero borrar: {ids_text}" if selected else "Confirmo que quiero borrar los registros seleccionados",
+        value=False,
+        key="br_confirm_" + hashlib.sha1(ids_text.encode()).hexdigest()[:12],
+    )
+    if st.button("Borrar seleccionadas", type="primary", disabled=(not selected or not confirm)):
+        db.delete_responses(selected)
+        _counts_by_municipality.clear()
+        st.success(f"Borradas {len(selected)} encuestas.")
+        st.rerun()
+
+def _bulk_delete(version_id: int):
+    """Borrado por filtros (fecha, municipio, datos de prueba) en lotes cortos con progreso."""
+    st.warning("⚠️ Esto elimina encuestas y sus respuestas. No se puede deshacer.")
+    locations = db.response_locations(version_id)
+    c1, c2 = st.columns(2)
+    with c1:
+        d_from = st.date_input("Desde", value=None, key="del_date_from", format="YYYY-MM-DD")
+        muni = st.selectbox(
+            "Municipio",
+            sorted({r["municipality"] for r in locations if r["municipality"]}),
+            index=None, placeholder="Todos", key="del_municipality",
+        )
+    with c2:
+        d_to = st.date_input("Hasta", value=None, key="del_date_to", format="YYYY-MM-DD")
+        kind = st.radio("Tipo", ["Todas", "Solo de prueba", "Solo reales"], horizontal=True, key="del_kind")
+    filters = {
+        "date_from": d_from,
+        "date_to": d_to,
+        "municipality": muni,
+        "is_test": {"Solo de prueba": True, "Solo reales": False}.get(kind),
+    }
+    filters = {k: v for k, v in filters.items() if v is not None}
+    n_match = db.count_responses_by_filter(version_id, filters)
+    st.caption(f"{n_match} encuestas cumplen los filtros." + ("" if filters else " (Sin filtros: TODAS las de esta versión.)"))
+    confirm = st.checkbox(f"Confirmo borrar estas {n_match} encuestas", value=False, key="del_confirm")
+    if st.button("Borrar por filtros", type="primary", disabled=(not n_match or not confirm)):
+        bar = st.progress(0.0, text="Borrando...")
+        ndel, nleft = db.delete_responses_by_filter(
+            version_id,
+            filters,
+            progress=lambda done, total: bar.progress(done / total, text=f"Borrando... {done}/{total}"),
+        )
+        st.session_state.pop("del_confirm", None)
+        _counts_by_municipality.clear()
+        if nleft:
+            st.warning(
+                f"Borradas {ndel} encuestas. {nleft} no se pudieron borrar porque se estaban guardando o "
+                "editando en ese momento; vuelve a intentarlo en unos segundos."
+            )
+        else:
+            st.success(f"Borradas {ndel} encuestas.")
+            st.rerun()
+
+def _versions_archive(version_id: int):
+    """Archivar versiones cerradas y exportar cualquier versión (también las archivadas)."""
+    st.caption(
+        "Archivar saca las encuestas de una versión cerrada de las tablas de trabajo (más rápidas para la versión activa) "
+        "y las guarda comprimidas. Se pueden seguir exportando desde aquí."
+    )
+    versions = db.list_versions()
+    st.dataframe(
+        pd.DataFrame(versions).rename(columns={
+            "id": "ID", "name": "Versión", "is_active": "Activa", "created_at": "Creada",
+            "archived_at": "Archivada", "n_live": "Encuestas", "n_archived": "Encuestas archivadas",
+        }),
+        use_container_width=True,
+        hide_index=True,
+    )
+    old = [v for v in versions if v["id"] != version_id]
+    if not old:
+        return
+    vsel = st.selectbox(
+        "Versión",
+        old,
+        format_func=lambda v: f"#{v['id']} {v['name']}" + (" (archivada)" if v["archived_at"] else ""),
+        key="arch_version",
+    )
+    c1, c2 = st.columns(2)
+    with c1:
+        can_archive = not vsel["is_active"] and not vsel["archived_at"]
+        if st.button("Archivar esta versión", disabled=not can_archive):
+            bar = st.progress(0.0, text="Archivando...")
+            narch = db.archive_version(
+                vsel["id"], progress=lambda done, total: bar.progress(done / total, text=f"Archivando... {done}/{total}"),
+            )
+            st.success(f"Listo. Se archivaron {narch} encuestas.")
+            st.rerun()
+    with c2:
+        if st.button("Exportar esta versión (Excel)"):
+            st.session_state["_export_job"] = exports.submit_export_job(vsel["id"], "xlsx")
 
 def results_page(version_id: int):
     st.title("Respuestas y exportación")
     n = db.count_responses(version_id)
     st.metric("Encuestas registradas", n)
 
-    # --- Administración: borrar registros ---
-    with st.expander("Borrar registros", expanded=True):
-        st.warning("⚠️ Esto elimina encuestas y sus respuestas. No se puede deshacer.")
-        rows = db.list_response_summaries(version_id, limit=300)
-        if not rows:
-            st.info("No hay registros para borrar.")
+    with st.expander("Encuestas por municipio", expanded=False):
+        by_muni = _counts_by_municipality(version_id)
+        if by_muni:
+            st.dataframe(
+                pd.DataFrame(by_muni).rename(columns={"province": "Provincia", "municipality": "Municipio", "n": "Encuestas"}),
+                use_container_width=True,
+                hide_index=True,
+            )
         else:
-            opts = [
-                f"#{r['id']} | {str(r['created_at'])[:19]}" for r in rows
-            ]
-            sel = st.multiselect("Selecciona encuestas a borrar", options=opts)
-            confirm = st.checkbox("Confirmo que quiero borrar los registros seleccionados", value=False)
-            c1, c2 = st.columns(2)
-            with c1:
-                if st.button("Borrar seleccionadas", type="primary", disabled=(not sel or not confirm)):
-                    ids = [int(x.split("|", 1)[0].replace("#", "").strip()) for x in sel]
-                    db.delete_responses(ids)
-                    st.success(f"Borradas {len(ids)} encuestas.")
-                    st.rerun()
-            with c2:
-                confirm_all = st.checkbox("Confirmo borrar TODAS las encuestas", value=False)
-                if st.button("Borrar TODO", disabled=(not confirm_all), help="Elimina todas las encuestas de esta versión"):
-                    db.delete_all_responses(version_id)
-                    st.success("Borradas todas las encuestas.")
-                    st.rerun()
-
-    
+            st.info("Aún no hay encuestas.")
+
+    # --- Administración: explorar / borrar registros ---
+    with st.expander("Explorar y borrar encuestas", expanded=True):
+        _response_browser(version_id)
+
+    with st.expander("Borrado masivo por filtros", expanded=False):
+        _bulk_delete(version_id)
+
     with st.expander("Reparar datos iniciales (si salen en blanco en el Excel)", expanded=False):
         st.info("Si ya registraste encuestas antes de las últimas actualizaciones, esto intenta rellenar Provincia/Municipio y campos de identificación dentro de metadata para que el Excel los muestre.")
         if st.button("Reparar datos iniciales en encuestas existentes"):
@@ -65,27 +236,104 @@ def results_page(version_id: int):
             st.success(f"Listo. Se actualizaron {nfix} encuestas.")
             st.rerun()
 
+    with st.expander("Tabla de resultados (formato ancho)", expanded=False):
+        fresh = db.results_wide_is_fresh(version_id)
+        st.info(
+            "La exportación lee una tabla ya calculada (1 fila por encuesta) que se actualiza al guardar cada encuesta. "
+            + ("Está al día." if fresh else "El formulario cambió: se recalculará en la próxima exportación.")
+        )
+        if st.button("Reconstruir ahora"):
+            with st.spinner("Reconstruyendo..."):
+                nrows = db.rebuild_results_wide(version_id)
+            st.success(f"Listo. {nrows} encuestas en la tabla.")
+
+    with st.expander("Versiones anteriores (archivo)", expanded=False):
+        _versions_archive(version_id)
+
+    with st.expander("Almacenamiento compacto (JSONB)", expanded=False):
+        st.info(
+            f"Modo actual de guardado: **{db.answers_storage()}** (variable ANSWERS_STORAGE). "
+            "Esto copia las respuestas guardadas como filas a un JSONB por encuesta y borra las filas. "
+            "La exportación lee ambos formatos."
+        )
+        if st.button("Migrar respuestas existentes a JSONB"):
+            with st.spinner("Migrando..."):
+                nmig = db.migrate_answers_to_jsonb(version_id)
+            st.success(f"Listo. Se migraron {nmig} encuestas.")
+
     st.caption("Exporta en formato ancho: 1 fila = 1 encuesta; columnas = preguntas.")
 
-    if st.button("Generar Excel", type="primary", disabled=(n==0)):
-        try:
-            df = db.export_answers_wide(version_id)
-        except Exception as e:
-            st.error(f"No se pudo exportar: {e}")
-            st.stop()
-        if df.empty:
-            st.warning("No hay datos para exportar.")
-            return
-        output = io.BytesIO()
-        with st.spinner("Generando Excel..."):
-            with st.container():
-                df = _excel_safe(df)
-                df.to_excel(output, index=False, sheet_name="respuestas")
-        output.seek(0)
+    with st.expander("Filtros de exportación", expanded=False):
+        opts = db.export_filter_options(version_id)
+        c1, c2 = st.columns(2)
+        with c1:
+            f_from = st.date_input("Desde", value=None, key="exp_date_from", format="YYYY-MM-DD")
+            f_prov = st.selectbox("Provincia", opts["provinces"], index=None, placeholder="Todas", key="exp_province")
+            f_id_from = st.number_input("Desde ID", min_value=1, value=None, step=1, key="exp_id_from")
+        with c2:
+            f_to = st.date_input("Hasta", value=None, key="exp_date_to", format="YYYY-MM-DD")
+            munis = (
+                opts["municipalities"].get(f_prov, [])
+                if f_prov
+                else sorted({m for ms in opts["municipalities"].values() for m in ms})
+            )
+            f_muni = st.selectbox("Municipio", munis, index=None, placeholder="Todos", key="exp_municipality")
+            f_id_to = st.number_input("Hasta ID", min_value=1, value=None, step=1, key="exp_id_to")
+        f_surveyor = st.text_input("Encuestador(a) contiene", key="exp_surveyor").strip()
+    filters = {
+        "date_from": f_from,
+        "date_to": f_to,
+        "province": f_prov,
+        "municipality": f_muni,
+        "surveyor": f_surveyor,
+        "id_from": f_id_from,
+        "id_to": f_id_to,
+    }
+    filters = {k: v for k, v in filters.items() if v not in (None, "")}
+    if filters:
+        n_filtered = db.count_export_rows(version_id, filters)
+        st.caption(f"Con los filtros: {n_filtered} encuestas.")
+    else:
+        n_filtered = n
+
+    fmt = st.selectbox(
+        "Formato",
+        options=list(exports.FORMATS.keys()),
+        format_func=lambda k: exports.FORMATS[k][0],
+        help="Excel para revisar a mano; CSV/Parquet/Arrow cargan mucho más rápido en herramientas de análisis.",
+    )
+    if st.button("Generar archivo", type="primary", disabled=(n_filtered==0)):
+        st.session_state["_export_job"] = exports.submit_export_job(version_id, fmt, filters=filters)
+
+    job = exports.get_job(st.session_state.get("_export_job"))
+    if not job:
+        return
+    if job["status"] in ("queued", "running"):
+        _export_progress(job["id"])
+        return
+    if job["status"] == "error":
+        st.error(f"No se pudo exportar: {job['error']}")
+        return
+    if job["hit"]:
+        st.caption("Sin cambios desde la última exportación: se reutilizó el archivo generado.")
+
+    header, rows = job["preview"]
+    if not rows:
+        st.warning("No hay datos para exportar.")
+        return
+    label, _, ext, mime = exports.FORMATS[job["fmt"]]
+    suffix = "" if job["version_id"] == version_id else f"_v{job['version_id']}"
+    try:
+        f = open(job["path"], "rb")
+    except FileNotFoundError:
+        # El archivo salió de la caché (p. ej. otro proceso la limpió): se genera de nuevo
+        st.session_state["_export_job"] = exports.submit_export_job(job["version_id"], job["fmt"], filters=job.get("filters"))
+        st.rerun()
+    with f:
         st.download_button(
-            label="Descargar Excel",
-            data=output,
-            file_name="respuestas_encuesta_pic.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            label=f"Descargar {label}",
+            data=f,
+            file_name=f"respuestas_encuesta_pic{suffix}.{ext}",
+            mime=mime,
         )
-        st.dataframe(df.head(20), use_container_width=True)
\ No newline at end of file
+    st.dataframe(pd.DataFrame(rows, columns=header), use_container_width=True)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Los módulos de la app (db, forms, exports, programs...) viven en la raíz del repo
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
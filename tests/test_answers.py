@@ -0,0 +1,53 @@
+import json
+import pytest
+import db
+
+
+@pytest.mark.parametrize("qtype, value, encoded, stored", [
+    ("yes_no", "Sí", ("Sí", True, None, None), True),
+    ("yes_no", "No", ("No", False, None, None), False),
+    ("text", "hola", ("hola", None, None, None), "hola"),
+    ("number", "12.5", (None, None, 12.5, None), 12.5),
+    ("number", "doce", ("doce", None, None, None), "doce"),
+    ("single_choice", "OTRA: x", ("OTRA: x", None, None, None), "OTRA: x"),
+    ("multi_choice", ["A", "B"], (None, None, None, '["A", "B"]'), ["A", "B"]),
+])
+def test_encode_and_json_value(qtype, value, encoded, stored):
+    assert db._encode_answer(qtype, value) == encoded
+    assert db._answer_json_value(qtype, encoded) == stored
+
+
+def test_encode_none_is_skipped():
+    assert db._encode_answer("text", None) is None
+
+
+def test_json_value_keeps_bool_of_former_yes_no():
+    assert db._answer_json_value("text", (None, True, None, None)) is True
+
+
+@pytest.mark.parametrize("qtype, value", [
+    ("yes_no", "Sí"), ("yes_no", "No"), ("text", "hola"), ("number", "3"), ("multi_choice", ["A"]),
+])
+def test_rows_and_jsonb_decode_the_same(qtype, value):
+    """Filas (survey_answers) y JSONB (ANSWERS_STORAGE=jsonb / archivo) exportan igual."""
+    text_val, bool_val, num_val, json_val = db._encode_answer(qtype, value)
+    from_rows = db._decode_answer(qtype, text_val, bool_val, num_val, json.loads(json_val) if json_val else None)
+    stored = json.loads(json.dumps(db._answer_json_value(qtype, (text_val, bool_val, num_val, json_val))))
+    assert db._decode_archived(qtype, stored) == from_rows
+
+
+def test_decode_answer_frame_matches_scalar_decoder():
+    import pandas as pd
+
+    rows = [
+        ("yes_no", "Sí", True, None, None),
+        ("yes_no", "No", False, None, None),
+        ("yes_no", None, None, None, None),
+        ("text", "hola", None, None, None),
+        ("number", None, None, 4.0, None),
+        ("multi_choice", None, None, None, ["A", "B"]),
+        ("multi_choice", None, None, None, '["C"]'),
+        ("text", None, None, None, None),
+    ]
+    df = pd.DataFrame(rows, columns=["qtype", "value_text", "value_bool", "value_number", "value_json"])
+    assert list(db._decode_answer_frame(df)) == [db._decode_answer(*r) for r in rows]
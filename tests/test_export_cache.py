@@ -0,0 +1,49 @@
+import os
+import exports
+
+
+def _file(d, name, size, mtime):
+    path = os.path.join(d, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_evict_removes_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXPORT_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("EXPORT_CACHE_MAX_MB", str(2500 / (1024 * 1024)))
+    old = _file(tmp_path, "old", 1000, 100)
+    mid = _file(tmp_path, "mid", 1000, 200)
+    new = _file(tmp_path, "new", 1000, 300)
+    exports._evict()
+    assert not os.path.exists(old)
+    assert os.path.exists(mid) and os.path.exists(new)
+
+
+def test_evict_skips_kept_paths(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXPORT_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("EXPORT_CACHE_MAX_MB", str(1500 / (1024 * 1024)))
+    old = _file(tmp_path, "old", 1000, 100)
+    mid = _file(tmp_path, "mid", 1000, 200)
+    new = _file(tmp_path, "new", 1000, 300)
+    exports._evict(keep={old, new})
+    assert os.path.exists(old) and os.path.exists(new)
+    assert not os.path.exists(mid)
+
+
+def test_cache_key_depends_on_watermark_format_and_filters():
+    wm = {"version_id": 1, "max_id": 10, "n": 10, "rebuilt_at": "", "archived_at": ""}
+    key = exports._cache_key(wm, "xlsx")
+    assert key.startswith("v1_")
+    assert exports._cache_key(dict(wm), "xlsx") == key
+    assert exports._cache_key(dict(wm, max_id=11), "xlsx") != key
+    assert exports._cache_key(wm, "parquet") != key
+    assert exports._cache_key(wm, "xlsx", {"municipality": "SAN GIL"}) != key
+    assert exports._cache_key(wm, "xlsx", exports._clean_filters({"province": None})) == key
+
+
+def test_key_lock_is_shared_per_key():
+    a = exports._key_lock("k1")
+    assert exports._key_lock("k1") is a
+    assert exports._key_lock("k2") is not a
@@ -0,0 +1,60 @@
+import datetime
+import pytest
+import db
+
+
+def test_no_filters_only_version():
+    assert db._export_filter_sql(7, None) == ("version_id=%s", [7])
+    assert db._export_filter_sql(7, {"province": None, "surveyor": ""}) == ("version_id=%s", [7])
+
+
+def test_unknown_filter_rejected():
+    with pytest.raises(ValueError, match="bogus"):
+        db._export_filter_sql(1, {"bogus": 1})
+
+
+def test_every_filter(monkeypatch):
+    monkeypatch.setenv("APP_TZ", "America/Bogota")
+    d1, d2 = datetime.date(2025, 3, 1), datetime.date(2025, 3, 31)
+    where, params = db._export_filter_sql(3, {
+        "date_from": d1, "date_to": d2, "province": "GUANENTÁ", "municipality": "SAN GIL",
+        "is_test": False, "surveyor": "ana", "id_from": "10", "id_to": 20,
+    })
+    assert where.split(" AND ") == [
+        "version_id=%s",
+        "created_at >= (%s::date)::timestamp AT TIME ZONE %s",
+        "created_at < ((%s::date) + 1)::timestamp AT TIME ZONE %s",
+        "province = %s",
+        "municipality = %s",
+        "COALESCE((metadata ->> 'is_test')::boolean, FALSE) = %s",
+        "metadata ->> 'encuestador' ILIKE %s ESCAPE '\\'",
+        "id >= %s",
+        "id <= %s",
+    ]
+    assert params == [3, d1, "America/Bogota", d2, "America/Bogota", "GUANENTÁ", "SAN GIL", False, "%ana%", 10, 20]
+    assert where.count("%s") == len(params)
+
+
+def test_alias_prefixes_every_column():
+    where, _ = db._export_filter_sql(1, {
+        "date_from": datetime.date(2025, 1, 1), "province": "X", "no_municipality": True,
+        "is_test": True, "surveyor": "a", "id_to": 5,
+    }, alias="r")
+    for cond in where.split(" AND "):
+        assert "r." in cond, cond
+    assert "r.municipality IS NULL" in where
+
+
+def test_no_municipality_false_is_ignored():
+    assert db._export_filter_sql(1, {"no_municipality": False}) == ("version_id=%s", [1])
+
+
+@pytest.mark.parametrize("text, pattern", [
+    ("ana", "%ana%"),
+    ("50%", "%50\\%%"),
+    ("a_b", "%a\\_b%"),
+    ("c:\\x", "%c:\\\\x%"),
+])
+def test_surveyor_is_matched_literally(text, pattern):
+    _, params = db._export_filter_sql(1, {"surveyor": text})
+    assert params[-1] == pattern
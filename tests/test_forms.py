@@ -0,0 +1,123 @@
+import pytest
+import forms
+
+
+def _q(qid, label, qtype="single_choice", code=None, config=None, options=()):
+    return {
+        "id": qid, "group_id": 1, "code": code, "qtype": qtype, "label": label, "text": label,
+        "help_text": None, "required": False, "sort_order": qid, "is_active": True,
+        "config": config or {}, "options": list(options),
+    }
+
+
+def _opt(oid, label, **meta):
+    return {"id": oid, "label": label, "value": label, "meta": meta}
+
+
+def _form(sections, muni_rows=()):
+    """sections: [(id, nombre, [(título del grupo, [preguntas])])]"""
+    tree = [
+        {
+            "id": sid, "name": name, "sort_order": sid, "is_active": True,
+            "groups": [
+                {"id": sid * 10 + i, "section_id": sid, "title": title, "sort_order": i, "is_active": True, "questions": qs}
+                for i, (title, qs) in enumerate(groups)
+            ],
+        }
+        for sid, name, groups in sections
+    ]
+    return forms.Form(1, 1, tree, list(muni_rows))
+
+
+def _cascade_form():
+    province = _q(1, "Provincia", code="province", options=[_opt(1, "GUANENTÁ"), _opt(2, "COMUNERA")])
+    municipality = _q(
+        2, "Municipio", code="municipality",
+        config={"depends_on": "province", "filter_option_meta_key": "province"},
+        options=[
+            _opt(10, "SAN GIL", province="GUANENTÁ"),
+            _opt(11, "CURITÍ", province="GUANENTÁ"),
+            _opt(12, "SOCORRO", province="COMUNERA"),
+            _opt(13, "SIN PADRE"),
+        ],
+    )
+    return _form([(1, "PREGUNTAS INICIALES", [("Ubicación", [province, municipality])])])
+
+
+def test_options_by_parent():
+    form = _cascade_form()
+    muni = form.questions[1]
+    assert dict(muni.options_by_parent) == {"GUANENTÁ": ("SAN GIL", "CURITÍ"), "COMUNERA": ("SOCORRO",)}
+    assert muni.depends_on_label == "Provincia"
+    # Las preguntas sin depends_on quedan sin índice
+    assert dict(form.questions[0].options_by_parent) == {}
+    assert form.questions[0].depends_on_label is None
+
+
+def test_depends_on_unknown_code_falls_back_to_code():
+    q = _q(1, "Vereda", config={"depends_on": "nope", "filter_option_meta_key": "m"}, options=[_opt(1, "A", m="x")])
+    form = _form([(1, "S", [("G", [q])])])
+    assert form.questions[0].depends_on_label == "nope"
+    assert dict(form.questions[0].options_by_parent) == {"x": ("A",)}
+
+
+def test_sections_for_municipality():
+    sections = [(1, "PREGUNTAS INICIALES", []), (2, "SALUD INFANTIL", []), (3, "SALUD LABORAL", [])]
+    form = _form(sections, [{"municipality_norm": "SAN GIL", "section_id": 3}])
+    assert [s.id for s in form.sections_for("San Gil")] == [1, 3]
+    # Sin municipio o sin relación conocida: todas
+    assert [s.id for s in form.sections_for(None)] == [1, 2, 3]
+    assert [s.id for s in form.sections_for("OTRO")] == [1, 2, 3]
+
+
+def test_freeze_and_thaw_roundtrip():
+    raw = {"a": [1, {"b": ["x", None]}], "c": {"d": True}}
+    frozen = forms._freeze(raw)
+    with pytest.raises(TypeError):
+        frozen["a"] = 1
+    assert isinstance(frozen["a"], tuple)
+    assert forms.thaw(frozen) == raw
+
+
+def test_model_is_immutable_and_slotted():
+    q = _cascade_form().questions[1]
+    with pytest.raises(AttributeError):
+        q.code = "x"
+    with pytest.raises(TypeError):
+        q.config["depends_on"] = "x"
+    assert not hasattr(q, "__dict__")
+    assert q.key == "q_2"
+    assert q.option_labels == ("SAN GIL", "CURITÍ", "SOCORRO", "SIN PADRE")
+
+
+def test_identity_fields():
+    form = _form([
+        (1, "PREGUNTAS INICIALES", [
+            ("Ubicación", [
+                _q(1, "Provincia", code="province"),
+                _q(2, "¿En qué provincia vive?"),  # duplicada sin code
+            ]),
+            ("Identificación", [
+                _q(3, "Nombre completo", qtype="text"),
+                _q(4, "Tipo de documento"),
+                _q(5, "Número de documento", qtype="text", code="doc_number"),
+                _q(6, "Correo electrónico", qtype="text"),
+                _q(7, "Edad", qtype="number"),
+            ]),
+        ]),
+        (2, "SALUD INFANTIL", [
+            ("Identificación", [_q(8, "Nombre del niño", qtype="text")]),
+            ("Otros", [_q(9, "Municipio de atención", code="municipality"), _q(10, "Vereda", code="vereda")]),
+        ]),
+    ])
+    assert dict(form.identity_fields) == {
+        1: ("province",),  # code + texto: sin repetir
+        2: ("province",),
+        3: ("full_name",),
+        4: ("doc_type",),
+        5: ("doc_number",),
+        6: ("email",),
+        # Fuera de PREGUNTAS INICIALES solo cuenta el code
+        9: ("municipality",),
+    }
+    assert all(f in forms.IDENTITY_FIELDS for fields in form.identity_fields.values() for f in fields)
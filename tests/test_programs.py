@@ -0,0 +1,60 @@
+import pytest
+import programs
+
+
+def test_norm_municipality():
+    assert programs.norm_municipality("  San Gil ") == "SAN GIL"
+    assert programs.norm_municipality("Girón") == "GIRON"
+    assert programs.norm_municipality("Carmen   de\tChucurí") == "CARMEN DE CHUCURI"
+    assert programs.norm_municipality(None) == ""
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("VIDA SALUDABLE Y CONDICIONES NO TRANSMISIBLES", ["ENFERMEDADES NO TRANSMISIBLES"]),
+    ("ENFERMEDADES CRÓNICAS NO TRANSMISIBLES", ["ENFERMEDADES NO TRANSMISIBLES"]),
+    ("TB Y HANSEN", ["ENFERMEDADES TRANSMISIBLES"]),
+    ("SALU INFANTIL", ["SALUD INFANTIL"]),
+    ("DERECHOS SEXULES Y REPRODUCTIVOS", ["SALUD SEXUAL Y REPRODUCTIVA"]),
+    ("ETV", ["ENFERMEDADES TRANSMITIDAS POR VECTORES – ETV"]),
+    # "TB" y "ETV" solo como palabra completa
+    ("PROMOCIÓN SOCIAL, ECONOMÍA POPULAR", []),
+    ("", []),
+])
+def test_sections_for_program_text(text, expected):
+    assert programs.sections_for_program_text(text) == expected
+
+
+def test_sections_keep_survey_order():
+    text = "SALUD SEXUAL, SALUD INFANTIL, VIDA SALUDABLE, ETV"
+    assert programs.sections_for_program_text(text) == [
+        "ENFERMEDADES NO TRANSMISIBLES",
+        "ENFERMEDADES TRANSMITIDAS POR VECTORES – ETV",
+        "SALUD INFANTIL",
+        "SALUD SEXUAL Y REPRODUCTIVA",
+    ]
+
+
+def test_shipped_json_matches_official_listing():
+    """data/municipio_programas.json debe ser la conversión del listado oficial."""
+    from_xlsx = programs.parse_xlsx(programs.DATA_DIR / "LISTADO_MUNICIPIOS_PROGRAMAS.xlsx")
+    from_json = programs.parse_json(programs.DEFAULT_JSON)
+    norm = programs.norm_municipality
+    assert {norm(m): sorted(s) for m, s in from_xlsx.items()} == {norm(m): sorted(s) for m, s in from_json.items()}
+
+
+def test_parse_xlsx_requires_header(tmp_path):
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    wb.active.append(["foo", "bar"])
+    wb.active.append(["SAN GIL", "SALUD INFANTIL"])
+    path = tmp_path / "sin_encabezado.xlsx"
+    wb.save(path)
+    with pytest.raises(ValueError):
+        programs.parse_xlsx(path)
+
+
+def test_parse_json_accepts_plain_mapping(tmp_path):
+    path = tmp_path / "m.json"
+    path.write_text('{"SAN GIL": ["SALUD INFANTIL"]}', encoding="utf-8")
+    assert programs.parse_json(path) == {"SAN GIL": ["SALUD INFANTIL"]}
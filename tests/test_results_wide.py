@@ -0,0 +1,82 @@
+import json
+import db
+
+
+def _qrow(qid, text, code=None, qtype="text", section="PREGUNTAS INICIALES", group="Identificación", visible=True):
+    return {
+        "id": qid, "code": code, "qtype": qtype, "question_text": text,
+        "section_name": section, "group_title": group, "is_visible": visible,
+    }
+
+
+QROWS = [
+    _qrow(1, "Provincia", code="province", group="Ubicación"),
+    _qrow(2, "Municipio", code="municipality", group="Ubicación"),
+    _qrow(3, "Nombre completo"),  # sin code: se resuelve por texto
+    _qrow(4, "Número de documento", code="doc_number"),
+    _qrow(5, "¿Asistió?", qtype="yes_no", section="SALUD INFANTIL", group="A"),
+    _qrow(6, "Oculta", section="SALUD INFANTIL", group="A", visible=False),
+]
+
+
+def _keys(values):
+    return dict(zip(db.WIDE_KEY_CODES, values))
+
+
+def test_key_precedence_code_then_metadata_then_text():
+    b = db._WideRowBuilder(QROWS)
+    meta = {"Provincia": "COMUNERA", "municipio": "SOCORRO", "full_name": "Desde metadata"}
+    keys, doc = b.build(meta, [(1, "GUANENTÁ"), (3, "Desde pregunta"), (5, "Sí")])
+    keys = _keys(keys)
+    assert keys["province"] == "GUANENTÁ"  # respuesta con code gana sobre metadata
+    assert keys["municipality"] == "SOCORRO"  # alias de metadata
+    assert keys["full_name"] == "Desde metadata"  # metadata gana sobre el match por texto
+    assert keys["doc_number"] is None
+    assert doc == {"1": "GUANENTÁ", "3": "Desde pregunta", "5": "Sí"}
+
+
+def test_text_match_fills_missing_keys():
+    b = db._WideRowBuilder(QROWS)
+    keys, _ = b.build('{"encuestador": "x"}', [(3, "Ana")])
+    assert _keys(keys)["full_name"] == "Ana"
+
+
+def test_unknown_questions_and_empty_answers_are_ignored():
+    b = db._WideRowBuilder(QROWS)
+    keys, doc = b.build(None, [(99, "x"), (4, None), (4, "123"), (4, "456")])
+    assert doc == {"4": "123"}  # la primera respuesta de cada pregunta
+    assert _keys(keys)["doc_number"] == "123"
+    assert b.qtype(5) == "yes_no" and b.qtype(99) is None
+
+
+def test_wide_row_serializes_keys_and_answers():
+    row = db._wide_row(7, 1, "2025-01-01", {"a": 1}, [1.0] + [None] * (len(db.WIDE_KEY_CODES) - 1), {"5": "Sí"})
+    assert row[:4] == (7, 1, "2025-01-01", '{"a": 1}')
+    assert row[4] == "1.0"
+    assert json.loads(row[-1]) == {"5": "Sí"}
+
+
+def test_question_header_order_and_duplicates():
+    qrows = [
+        _qrow(1, "Edad", section="S", group="G"),
+        _qrow(2, "Edad", section="S", group="G"),
+        _qrow(3, "Oculta", section="S", group="G", visible=False),
+        _qrow(4, "Sexo", section="S", group="G"),
+    ]
+    assert db.export_question_header(qrows) == [
+        (1, "S | G | Edad [#1]"),
+        (2, "S | G | Edad [#2]"),
+        (4, "S | G | Sexo"),
+    ]
+
+
+def test_number_column_with_free_text_is_exported_as_text(monkeypatch):
+    qrows = [
+        _qrow(1, "Edad", qtype="number", section="S", group="G"),
+        _qrow(2, "Hijos", qtype="number", section="S", group="G"),
+        _qrow(3, "¿Asistió?", qtype="yes_no", section="S", group="G"),
+    ]
+    monkeypatch.setattr(db, "export_questions", lambda _vid: qrows)
+    monkeypatch.setattr(db, "_number_questions_with_text", lambda _vid, qids: {2} & set(qids))
+    kinds = db.export_column_kinds(1)
+    assert kinds[-3:] == ["number", "text", "bool"]